@@ -0,0 +1,50 @@
+"""Отдельный процесс Telegram-бота для режима bot.mode: external.
+
+Веб-часть в этом режиме не трогает бота, поэтому её можно запускать
+с несколькими воркерами (uvicorn main:app --workers N), а апдейты
+получает ровно один процесс:
+
+    python bot_worker.py
+
+Транспорт задаётся bot.worker_transport: "polling" или "webhook"
+(aiohttp-сервер на bot.webhook_listen, адрес для Telegram - bot.webhook_url).
+"""
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from main import (
+    bot, dp, init_db, ALLOWED_UPDATES,
+    BOT_WORKER_TRANSPORT, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_LISTEN
+)
+
+async def run_polling():
+    await init_db()
+    await bot.delete_webhook()
+    try:
+        await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+    finally:
+        await bot.session.close()
+
+def run_webhook():
+    async def on_startup(bot):
+        await init_db()
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+
+    dp.startup.register(on_startup)
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET) \
+        .register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    host, port = WEBHOOK_LISTEN.rsplit(":", 1)
+    web.run_app(app, host=host, port=int(port))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if BOT_WORKER_TRANSPORT == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(run_polling())
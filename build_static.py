@@ -0,0 +1,193 @@
+"""Сборка статики Mini App в static/dist.
+
+- картинки, звуки и прочие файлы копируются в dist/assets с хэшем содержимого в имени
+  (их можно кэшировать навсегда: новое содержимое - новое имя);
+- рядом с каждой PNG/JPEG кладутся .webp и .avif (нужен Pillow), сервер отдаёт их по
+  заголовку Accept, исходный формат остаётся запасным;
+- иконки и поплавок ужимаются до двойного размера на экране;
+- --atlas собирает рыб из FISH_TABLE в один спрайт: все картинки улова одним запросом;
+- index.html получает хэшированные ссылки и карту ассетов (window.ASSETS),
+  плюс сжатые копии .gz и .br (нужен пакет brotli).
+
+    pip install pillow brotli   # необязательно: без них только хэши и gzip
+    python build_static.py --atlas
+
+Сервер (main.py) берёт файлы из static.build_dir, если папка есть, иначе из static/ как раньше.
+После правки static/ сборку нужно повторить.
+"""
+import io
+import os
+import re
+import sys
+import gzip
+import json
+import math
+import shutil
+import hashlib
+import argparse
+from fnmatch import fnmatch
+
+import yaml
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from game_rules import FISH_TABLE
+
+def configured_build_dir():
+    """static.build_dir из конфига сервера - туда же по умолчанию пишет сборка."""
+    try:
+        with open(os.environ.get("CONFIG_PATH", "config.yaml")) as f:
+            config = yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        config = {}
+    return config.get('static', {}).get('build_dir', os.path.join("static", "dist"))
+
+BUILD_DIR = configured_build_dir()
+SKIP = ("*.txt", "*.md")
+IMAGE_TYPES = (".png", ".jpg", ".jpeg")
+COMPRESS_TYPES = (".html", ".css", ".js", ".json", ".svg")
+# Ограничение стороны картинки: 2x от размера в вёрстке (иконки меню 48px, поплавок 220px)
+MAX_SIDE = {"images/icon_*.png": 96, "images/float.png": 440}
+ATLAS_CELL = 128
+WEBP_QUALITY = 82
+AVIF_QUALITY = 60
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts: digest.update(part)
+    return digest.hexdigest()[:10]
+
+def encode(image, fmt, **options):
+    out = io.BytesIO()
+    image.save(out, fmt, **options)
+    return out.getvalue()
+
+def optimize_image(path, data):
+    """(основной файл, {".webp": ..., ".avif": ...}); без Pillow - файл как есть."""
+    if Image is None: return data, {}
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    fmt = "PNG" if path.lower().endswith(".png") else "JPEG"
+    limit = next((side for pattern, side in MAX_SIDE.items() if fnmatch(path, pattern)), None)
+    if limit and max(image.size) > limit:
+        image.thumbnail((limit, limit), Image.LANCZOS)
+        data = encode(image, fmt, optimize=True, **({"quality": 85} if fmt == "JPEG" else {}))
+    elif fmt == "PNG":
+        # PNG пережимается без потерь; JPEG без ресайза не трогаем
+        recoded = encode(image, fmt, optimize=True)
+        if len(recoded) < len(data): data = recoded
+    return data, modern_variants(image, len(data))
+
+def modern_variants(image, base_size):
+    # Вариант берём, только если он действительно меньше исходного формата
+    variants = {}
+    if features.check("webp"):
+        variants[".webp"] = encode(image, "WEBP", quality=WEBP_QUALITY, method=6)
+    if features.check("avif"):
+        variants[".avif"] = encode(image, "AVIF", quality=AVIF_QUALITY)
+    return {ext: body for ext, body in variants.items() if len(body) < base_size}
+
+def compressed_copies(data):
+    copies = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        copies[".br"] = brotli.compress(data, quality=11)
+    return {ext: body for ext, body in copies.items() if len(body) < len(data)}
+
+def hashed_name(path, data, variants):
+    stem, ext = os.path.splitext(os.path.basename(path))
+    # В хэш входят и варианты: другое качество WebP/AVIF - другое имя, иначе клиент застрянет на старом
+    return f"assets/{stem}.{content_hash(data, *variants.values())}{ext}"
+
+def write(output, name, data, variants=None):
+    target = os.path.join(output, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as f:
+        f.write(data)
+    for ext, body in (variants or {}).items():
+        with open(target + ext, "wb") as f:
+            f.write(body)
+    return len(data) + sum(len(body) for body in (variants or {}).values())
+
+def build_atlas(source, output):
+    """Спрайт из картинок рыб FISH_TABLE: квадратные ячейки ATLAS_CELL, рыба вписана по центру."""
+    fish_ids = [fish['id'] for fish in FISH_TABLE if os.path.exists(os.path.join(source, "images", f"{fish['id']}.png"))]
+    cols = math.ceil(math.sqrt(len(fish_ids)))
+    rows = math.ceil(len(fish_ids) / cols)
+    atlas = Image.new("RGBA", (cols * ATLAS_CELL, rows * ATLAS_CELL))
+    for index, fish_id in enumerate(fish_ids):
+        image = Image.open(os.path.join(source, "images", f"{fish_id}.png")).convert("RGBA")
+        image.thumbnail((ATLAS_CELL, ATLAS_CELL), Image.LANCZOS)
+        x = (index % cols) * ATLAS_CELL + (ATLAS_CELL - image.width) // 2
+        y = (index // cols) * ATLAS_CELL + (ATLAS_CELL - image.height) // 2
+        atlas.paste(image, (x, y))
+    data = encode(atlas, "PNG", optimize=True)
+    variants = modern_variants(atlas, len(data))
+    name = hashed_name("fish-atlas.png", data, variants)
+    size = write(output, name, data, variants)
+    return {"url": name, "cols": cols, "rows": rows, "fish": {fish_id: i for i, fish_id in enumerate(fish_ids)}}, size
+
+def rewrite_html(html, files, manifest):
+    # Ссылки вида /static/<путь> на собранные файлы; динамические пути JS берёт из window.ASSETS
+    for path, name in files.items():
+        html = re.sub(r"/static/" + re.escape(path) + r"(?=[\"')\s>?#])", "/static/" + name, html)
+    script = f"<script>window.ASSETS = {json.dumps(manifest, separators=(',', ':'))};</script>"
+    return html.replace("</head>", f"    {script}\n</head>", 1)
+
+def build(source, output, atlas):
+    if os.path.exists(output): shutil.rmtree(output)
+    os.makedirs(output)
+    files, before, after = {}, 0, 0
+    # Прошлые сборки (в том числе static/dist при --output в другое место) - не исходники
+    skip_dirs = {os.path.abspath(output), os.path.abspath(BUILD_DIR)}
+
+    for root, dirs, names in os.walk(source):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) not in skip_dirs]
+        for filename in sorted(names):
+            full = os.path.join(root, filename)
+            path = os.path.relpath(full, source).replace(os.sep, "/")
+            if path == "index.html" or any(fnmatch(filename, pattern) for pattern in SKIP): continue
+            with open(full, "rb") as f:
+                data = f.read()
+            before += len(data)
+            variants = {}
+            if path.lower().endswith(IMAGE_TYPES):
+                data, variants = optimize_image(path, data)
+            elif path.endswith(COMPRESS_TYPES):
+                variants = compressed_copies(data)
+            files[path] = hashed_name(path, data, variants)
+            after += write(output, files[path], data, variants)
+
+    manifest = {"files": files}
+    if atlas:
+        if Image is None: sys.exit("--atlas needs Pillow: pip install pillow")
+        manifest["atlas"], size = build_atlas(source, output)
+        after += size
+
+    with open(os.path.join(source, "index.html"), encoding="utf-8") as f:
+        html = rewrite_html(f.read(), files, manifest).encode()
+    copies = compressed_copies(html)
+    write(output, "index.html", html, copies)
+    with open(os.path.join(output, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    print(f"{len(files)} assets: {before // 1024} KB -> {after // 1024} KB with all variants"
+          f"{' (no Pillow: images copied as is)' if Image is None else ''}")
+    print(f"index.html: {len(html) // 1024} KB, " + ", ".join(f"{ext} {len(body) // 1024} KB" for ext, body in copies.items()))
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Сборка статики FishingGame")
+    parser.add_argument("--source", default="static")
+    parser.add_argument("--output", default=BUILD_DIR)
+    parser.add_argument("--atlas", action="store_true", help="собрать спрайт рыб (нужен Pillow)")
+    args = parser.parse_args()
+    build(args.source, args.output, args.atlas)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,307 @@
+"""Правила игры: баланс, таблица рыб и формулы клика, покупок и оффлайн-дохода.
+
+Без зависимостей от конфига, БД и бота: этот же код использует сервер (main.py)
+и симулятор экономики (simulate.py), поэтому баланс правится только здесь.
+"""
+import random
+
+try:
+    import numpy as np  # необязательно: только для FishSampler.sample_many/pick_many
+except ImportError:
+    np = None
+
+# --- БАЛАНС И КОНСТАНТЫ ---
+
+# Цены на удочки (Сглаженная прогрессия)
+ROD_PRICES = {
+    1: 0, 2: 300, 3: 1000, 4: 3500, 5: 12000, 
+    6: 40000, 7: 120000, 8: 400000, 9: 1000000, 10: 3000000
+}
+
+# Цены на лодки
+BOAT_PRICES = {1: 1500, 2: 8000, 3: 35000, 4: 150000, 5: 800000}
+
+# БАЛАНС ЛОДОК (HARD NERF)
+# Доход в секунду (сильно уменьшен, чтобы не убивать активную игру)
+BOAT_INCOME = {
+    0: 0, 
+    1: 0.1,   # ~360 монет/час
+    2: 0.5,   # ~1800 монет/час
+    3: 2.5,   # ~9000 монет/час
+    4: 10.0,  # ~36k монет/час
+    5: 40.0   # ~144k монет/час
+}
+
+# ВМЕСТИМОСТЬ ТРЮМА (В часах)
+# Лодка перестает приносить доход, если игрок не заходил дольше этого времени
+BOAT_MAX_HOURS = {
+    0: 0, 
+    1: 2,   # Нужно заходить каждые 2 часа
+    2: 4,   
+    3: 8,   # Ночной режим
+    4: 12,  
+    5: 24   # Сутки
+}
+
+# Расходники
+CONSUMABLES = {
+    "energy_drink": {"price": 400, "energy": 50},  
+    "bait_common": {"price": 100, "amount": 10},   # 10 монет/шт
+    "bait_rare": {"price": 800, "amount": 5}       # 160 монет/шт
+}
+
+ENERGY_REGEN_PER_SEC = 0.6  # Полное восстановление ~2.7 минуты
+MAX_ENERGY = 100
+CLICK_COOLDOWN = 0.5        # Задержка между кликами (анти-кликер)
+ENERGY_COST = 2.0           # Фиксированная цена клика (убрали наказание за усталость)
+ACTIVE_REGEN_DELAY = 5      # Во время игры энергия восстанавливается только после паузы дольше этой (сек.)
+
+# Наживка: бонус к шансу и код для users.last_bait
+BAIT_BOOST = {"common": 0.15, "rare": 0.35}
+BAIT_CODES = {None: 0, "common": 1, "rare": 2}
+
+# SOFT LAUNCH: стартовые ресурсы новичка
+START_BALANCE = 200     # Стартовый бонус
+START_BAIT_COMMON = 5   # 5 бесплатных червей
+
+# Таблица рыб
+FISH_TABLE = [
+    # Мусор (trash) - теперь дает небольшую награду
+    {"id": "weed", "emoji": "🌿", "mult": 0.0, "weight": 20, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
+    {"id": "boot", "emoji": "👢", "mult": 0.0, "weight": 10, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
+    {"id": "tin", "emoji": "🥫", "mult": 0.0, "weight": 10, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
+    {"id": "bone", "emoji": "☠️", "mult": 0.0, "weight": 8, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
+    {"id": "bag", "emoji": "🛍️", "mult": 0.0, "weight": 8, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
+    {"id": "tire", "emoji": "🍩", "mult": 0.0, "weight": 5, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
+    # Обычные (rarity 1)
+    {"id": "minnow", "emoji": "🐟", "mult": 1.0, "weight": 45, "color": "#fff", "is_trash": False, "min_w": 0.05, "max_w": 0.15, "rarity": 1},
+    {"id": "shrimp", "emoji": "🦐", "mult": 1.2, "weight": 40, "color": "#e2e8f0", "is_trash": False, "min_w": 0.01, "max_w": 0.05, "rarity": 1},
+    {"id": "sardine", "emoji": "🐟", "mult": 1.5, "weight": 30, "color": "#cbd5e1", "is_trash": False, "min_w": 0.1, "max_w": 0.3, "rarity": 1},
+    {"id": "carp", "emoji": "🎏", "mult": 1.8, "weight": 25, "color": "#fbbf24", "is_trash": False, "min_w": 0.5, "max_w": 2.5, "rarity": 1},
+    {"id": "perch", "emoji": "🐠", "mult": 2.0, "weight": 25, "color": "#a5f3fc", "is_trash": False, "min_w": 0.3, "max_w": 1.2, "rarity": 1},
+    {"id": "trout", "emoji": "🐟", "mult": 2.5, "weight": 20, "color": "#86efac", "is_trash": False, "min_w": 1.0, "max_w": 4.0, "rarity": 1},
+    # Редкие (rarity 2)
+    {"id": "clown", "emoji": "🤡", "mult": 3.0, "weight": 18, "color": "#f97316", "is_trash": False, "min_w": 0.1, "max_w": 0.3, "rarity": 2},
+    {"id": "crab", "emoji": "🦀", "mult": 3.5, "weight": 15, "color": "#f87171", "is_trash": False, "min_w": 1.0, "max_w": 5.0, "rarity": 2},
+    {"id": "jelly", "emoji": "🪼", "mult": 4.0, "weight": 12, "color": "#c084fc", "is_trash": False, "min_w": 0.5, "max_w": 2.0, "rarity": 2},
+    {"id": "squid", "emoji": "🦑", "mult": 5.0, "weight": 10, "color": "#f472b6", "is_trash": False, "min_w": 0.5, "max_w": 3.0, "rarity": 2},
+    {"id": "seahorse", "emoji": "🐉", "mult": 6.0, "weight": 10, "color": "#fde047", "is_trash": False, "min_w": 0.01, "max_w": 0.05, "rarity": 2},
+    {"id": "pike", "emoji": "🐊", "mult": 7.0, "weight": 8, "color": "#4ade80", "is_trash": False, "min_w": 2.0, "max_w": 12.0, "rarity": 2},
+    {"id": "eel", "emoji": "🐍", "mult": 8.0, "weight": 7, "color": "#facc15", "is_trash": False, "min_w": 1.0, "max_w": 5.0, "rarity": 2},
+    # Эпические (rarity 3)
+    {"id": "tuna", "emoji": "🐟", "mult": 12.0, "weight": 6, "color": "#60a5fa", "is_trash": False, "min_w": 20.0, "max_w": 250.0, "rarity": 3},
+    {"id": "sword", "emoji": "🗡️", "mult": 15.0, "weight": 5, "color": "#93c5fd", "is_trash": False, "min_w": 30.0, "max_w": 300.0, "rarity": 3},
+    {"id": "ray", "emoji": "👿", "mult": 20.0, "weight": 4, "color": "#818cf8", "is_trash": False, "min_w": 5.0, "max_w": 50.0, "rarity": 3},
+    {"id": "catfish", "emoji": "🐡", "mult": 25.0, "weight": 4, "color": "#d946ef", "is_trash": False, "min_w": 10.0, "max_w": 100.0, "rarity": 3},
+    {"id": "angler", "emoji": "👾", "mult": 35.0, "weight": 3, "color": "#a855f7", "is_trash": False, "min_w": 2.0, "max_w": 10.0, "rarity": 3},
+    {"id": "turtle", "emoji": "🐢", "mult": 40.0, "weight": 3, "color": "#22c55e", "is_trash": False, "min_w": 30.0, "max_w": 150.0, "rarity": 3},
+    # Легендарные (rarity 4)
+    {"id": "shark", "emoji": "🦈", "mult": 60.0, "weight": 2.5, "color": "#eab308", "is_trash": False, "min_w": 300.0, "max_w": 1500.0, "rarity": 4},
+    {"id": "whale", "emoji": "🐳", "mult": 120.0, "weight": 1.5, "color": "#3b82f6", "is_trash": False, "min_w": 2000.0, "max_w": 10000.0, "rarity": 4},
+    {"id": "chest", "emoji": "👑", "mult": 250.0, "weight": 0.5, "color": "#facc15", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 4},
+    {"id": "mega", "emoji": "🦖", "mult": 500.0, "weight": 0.2, "color": "#ef4444", "is_trash": False, "min_w": 5000.0, "max_w": 20000.0, "rarity": 4},
+    {"id": "kraken", "emoji": "🐙", "mult": 1000.0, "weight": 0.1, "color": "#dc2626", "is_trash": False, "min_w": 10000.0, "max_w": 50000.0, "rarity": 4},
+]
+
+# Индекс рыб по id
+FISH_BY_ID = {f['id']: f for f in FISH_TABLE}
+
+# Коды рыб в catches/catch_daily. Коды не переиспользуются и не перенумеровываются:
+# новая рыба получает следующий свободный номер, удалённая оставляет свой код занятым.
+FISH_CODES = {
+    "weed": 1, "boot": 2, "tin": 3, "bone": 4, "bag": 5, "tire": 6,
+    "minnow": 7, "shrimp": 8, "sardine": 9, "carp": 10, "perch": 11, "trout": 12,
+    "clown": 13, "crab": 14, "jelly": 15, "squid": 16, "seahorse": 17, "pike": 18, "eel": 19,
+    "tuna": 20, "sword": 21, "ray": 22, "catfish": 23, "angler": 24, "turtle": 25,
+    "shark": 26, "whale": 27, "chest": 28, "mega": 29, "kraken": 30,
+}
+UNKNOWN_FISH_CODE = 0  # fish_id из старых записей, которого уже нет в FISH_TABLE
+assert set(FISH_CODES) == set(FISH_BY_ID), "every fish in FISH_TABLE needs a code in FISH_CODES"
+FISH_BY_CODE = {code: FISH_BY_ID[fish_id] for fish_id, code in FISH_CODES.items()}
+TRASH_CODES = [code for code, fish in FISH_BY_CODE.items() if fish['is_trash']]
+
+# --- ВЫБОР УЛОВА: ALIAS-ТАБЛИЦЫ (метод Уолкера/Воуза) ---
+# Таблицы строятся один раз при старте, выбор рыбы за O(1) без аллокаций на клик.
+class FishSampler:
+    def __init__(self, table, weights):
+        n = len(table)
+        total = float(sum(weights))
+        if n == 0 or total <= 0:
+            raise ValueError("Loot table has no positive weights")
+
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+
+        self.table = table
+        self.prob = prob
+        self.alias = alias
+        self.size = n
+        if np is not None:
+            self.prob_array = np.array(prob)
+            self.alias_array = np.array(alias, np.int64)
+
+    def index(self, u):
+        """Номер в table для равномерного u из [0, 1): столбец u * n, в нём своя рыба или её alias."""
+        u *= self.size
+        i = int(u)
+        return i if (u - i) < self.prob[i] else self.alias[i]
+
+    def sample(self, rnd=random.random):
+        return self.table[self.index(rnd())]
+
+    def pick_many(self, u):
+        """index() для массива u разом (NumPy): те же номера, что дал бы sample() на тех же числах."""
+        if np is None:
+            return [self.index(x) for x in u]
+        u = np.asarray(u) * self.size
+        i = u.astype(np.int64)
+        return np.where(u - i < self.prob_array.take(i), i, self.alias_array.take(i))
+
+    def sample_many(self, n, rng=None):
+        """n номеров рыб в table за один вызов. rng - numpy.random.Generator (без NumPy - random.Random)."""
+        if np is None:
+            rnd = (rng or random).random
+            return [self.index(rnd()) for _ in range(n)]
+        return self.pick_many((rng or np.random.default_rng()).random(n))
+
+def loot_weights(bait, rod_level):
+    """Веса FISH_TABLE для режима наживки ("none"/"common"/"rare") и уровня удочки."""
+    # Если редкая наживка: убираем мусор, НО оставляем Сундук (Chest)
+    if bait == "rare":
+        return [f['weight'] if (not f['is_trash'] or f['id'] == 'chest') else 0 for f in FISH_TABLE]
+    return [f['weight'] for f in FISH_TABLE]
+
+def build_fish_samplers():
+    samplers = {}
+    cache = {}  # одинаковые наборы весов делят одну таблицу
+    for bait in ("none", "common", "rare"):
+        for rod_level in ROD_PRICES:
+            weights = tuple(loot_weights(bait, rod_level))
+            if weights not in cache:
+                cache[weights] = FishSampler(FISH_TABLE, weights)
+            samplers[(bait, rod_level)] = cache[weights]
+    return samplers
+
+FISH_SAMPLERS = build_fish_samplers()
+
+def get_fish_sampler(bait, rod_level):
+    return FISH_SAMPLERS.get((bait or "none", rod_level)) or FISH_SAMPLERS[(bait or "none", 1)]
+
+# --- ПРАВИЛА КЛИКА (общие для всех путей записи) ---
+def choose_bait(user):
+    """Какую наживку тратит клик: сначала редкая, потом обычная."""
+    if user.bait_rare > 0: return "rare"
+    if user.bait_common > 0: return "common"
+    return None
+
+def catch_chance(rod_level, bait):
+    # База 30% + бонус за уровень удочки + наживка (макс 95%)
+    return min(0.30 + (rod_level * 0.04) + BAIT_BOOST.get(bait, 0.0), 0.95)
+
+def roll_weight(fish):
+    if fish['is_trash']: return 0.0
+    return round(random.uniform(fish['min_w'], fish['max_w']), 2)
+
+def catch_reward(fish, rod_level):
+    # Нелинейный рост силы удочки (x^1.15), чтобы поспевать за ценами
+    rod_multiplier = rod_level ** 1.15
+    if fish['is_trash'] and fish['id'] != 'chest':
+        # "Эко-сбор": символическая плата за мусор
+        return int(5 * rod_multiplier)
+    return int(15 * rod_multiplier * fish['mult'])
+
+def apply_click(user, rnd=random.random):
+    """Клик после начисления дохода и проверки кулдауна: тратит энергию и наживку,
+    начисляет награду. Возвращает (status, fish, reward, used_bait); fish есть только у "caught"."""
+    if user.energy < ENERGY_COST:
+        return "no_energy", None, 0, None
+
+    # --- ЛОГИКА НАЖИВКИ ---
+    used_bait = choose_bait(user)
+    if used_bait == "rare": user.bait_rare -= 1
+    elif used_bait == "common": user.bait_common -= 1
+
+    user.energy = max(0.0, user.energy - ENERGY_COST)
+
+    # Промах
+    if rnd() > catch_chance(user.rod_level, used_bait):
+        return "miss", None, 0, used_bait
+
+    # ВЫБОР РЫБЫ (таблицы предрассчитаны, см. FISH_SAMPLERS)
+    fish = get_fish_sampler(used_bait, user.rod_level).sample(rnd)
+    reward = catch_reward(fish, user.rod_level)
+    user.balance += reward
+    return "caught", fish, reward, used_bait
+
+def apply_purchase(user, item_id):
+    """Покупка снасти или расходника (доход уже зафиксирован). True, если прошла."""
+    if item_id in ("rod", "boat"):
+        field = f"{item_id}_level"
+        price = upgrade_price(item_id, getattr(user, field))
+        if not price or user.balance < price: return False
+        user.balance -= price
+        setattr(user, field, getattr(user, field) + 1)
+        return True
+
+    item = CONSUMABLES.get(item_id)
+    if item is None or user.balance < item['price']: return False
+    user.balance -= item['price']
+    if item_id == "energy_drink":
+        user.energy = min(MAX_ENERGY, user.energy + item['energy'])
+    else:
+        setattr(user, item_id, getattr(user, item_id) + item['amount'])
+    return True
+
+def upgrade_price(item_id, level):
+    """Цена следующего уровня удочки/лодки; None, если уровень максимальный."""
+    prices = ROD_PRICES if item_id == "rod" else BOAT_PRICES
+    return prices.get(level + 1)
+
+def ad_reward_amount(rod_level):
+    # 500 база + (уровень * 250). На 10 уровне ~3000 монет.
+    return 500 + rod_level * 250
+
+
+# --- ЛОГИКА ОФФЛАЙН ПРОГРЕССА С ЛИМИТАМИ ---
+def offline_progress(user, current_time, is_active=False):
+    """Доход лодки и энергия на момент current_time в закрытой форме (user не меняется)."""
+    time_diff = current_time - user.last_active_at
+    if time_diff < 0: time_diff = 0
+    
+    # 1. Лимит по времени работы лодки (вместимость трюма)
+    max_hours = BOAT_MAX_HOURS.get(user.boat_level, 0)
+    max_seconds = max_hours * 3600
+    effective_time = min(time_diff, max_seconds)
+    
+    # 2. Начисление денег за эффективное время
+    income = BOAT_INCOME.get(user.boat_level, 0)
+    earned = int(effective_time * income)
+    
+    # 3. Восстановление энергии (за ВСЁ время отсутствия, тут лимит лодки не влияет)
+    energy = user.energy
+    if not is_active or time_diff > ACTIVE_REGEN_DELAY:
+        restored_energy = time_diff * ENERGY_REGEN_PER_SEC
+        energy = min(MAX_ENERGY, user.energy + restored_energy)
+    
+    return earned, energy
+
+def calculate_offline_progress(user, current_time, is_active=False):
+    earned, energy = offline_progress(user, current_time, is_active)
+    user.balance += earned
+    user.energy = energy
+    user.last_active_at = current_time
+    return earned
+
+def hold_is_full(user, current_time):
+    """Трюм заполнен: дальше лодка не зарабатывает, пока доход не зафиксирован."""
+    max_seconds = BOAT_MAX_HOURS.get(user.boat_level, 0) * 3600
+    return max_seconds > 0 and current_time - user.last_active_at >= max_seconds
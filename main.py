@@ -1,14 +1,26 @@
+import os
 import yaml
 import logging
 import random
 import time
+import sqlite3
 import asyncio
+import json
 import hashlib  # Для генерации ID результата inline
-from datetime import datetime, timedelta
+import hmac
+import re
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from urllib.parse import urlsplit
+from fastapi import FastAPI, Request, Depends, HTTPException
+from fastapi.responses import StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 # Импортируем нужные типы для Inline Mode
 from aiogram.types import (
     WebAppInfo, 
@@ -18,14 +30,30 @@ from aiogram.types import (
     InlineKeyboardButton
 )
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, BigInteger, Integer, String, Float, Boolean, DateTime, desc, select, func
-from pydantic import BaseModel
+from sqlalchemy.orm import sessionmaker, declarative_base, make_transient
+from sqlalchemy import event, Column, Index, BigInteger, SmallInteger, Integer, String, Float, DateTime, Date, desc, select, func, update, delete, case, cast, inspect, text, table, column, literal, bindparam, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from pydantic import BaseModel, ValidationError
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from game_rules import (
+    ROD_PRICES, BOAT_PRICES, BOAT_INCOME, BOAT_MAX_HOURS, CONSUMABLES,
+    ENERGY_REGEN_PER_SEC, MAX_ENERGY, CLICK_COOLDOWN, ENERGY_COST, ACTIVE_REGEN_DELAY, BAIT_CODES,
+    FISH_TABLE, FISH_BY_ID, FISH_CODES, UNKNOWN_FISH_CODE, FISH_BY_CODE, TRASH_CODES, FISH_SAMPLERS,
+    START_BALANCE, START_BAIT_COMMON, get_fish_sampler, catch_chance, roll_weight, catch_reward,
+    apply_click, apply_purchase, upgrade_price, ad_reward_amount,
+    offline_progress, calculate_offline_progress, hold_is_full
+)
 
 # --- КОНФИГУРАЦИЯ ---
 def load_config():
     try:
-        with open("config.yaml", "r") as f:
+        # CONFIG_PATH - альтернативный конфиг (например, для bench.py)
+        with open(os.environ.get("CONFIG_PATH", "config.yaml"), "r") as f:
             return yaml.safe_load(f)
     except FileNotFoundError:
         return {}
@@ -37,9 +65,90 @@ WEBAPP_URL = config.get('bot', {}).get('webapp_url', "")
 # Ссылка на запуск игры. Если нет, пытаемся собрать из WEBAPP_URL
 BOT_APP_LINK = config.get('bot', {}).get('bot_app_link', f"{WEBAPP_URL}/static/index.html")
 
+# Где работает бот: "polling" - внутри веб-процесса (только при одном воркере uvicorn),
+# "webhook" - маршрут вебхука на этом же FastAPI-приложении (можно с несколькими воркерами),
+# "external" - отдельным процессом (python bot_worker.py), веб-процесс обслуживает только API
+BOT_MODE = config.get('bot', {}).get('mode', "polling")
+# Настройки для bot_worker.py: long polling или вебхук на собственном aiohttp-сервере
+BOT_WORKER_TRANSPORT = config.get('bot', {}).get('worker_transport', "polling")
+WEBHOOK_URL = config.get('bot', {}).get('webhook_url', "")
+# Без явного секрета берём производный от токена: одинаковый во всех воркерах и не угадываемый снаружи
+WEBHOOK_SECRET = config.get('bot', {}).get('webhook_secret', "") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_PATH = urlsplit(WEBHOOK_URL).path or "/tg/webhook"
+WEBHOOK_LISTEN = config.get('bot', {}).get('webhook_listen', "0.0.0.0:8081")
+WEBHOOK_WORKERS = config.get('bot', {}).get('webhook_workers', 8)
+WEBHOOK_QUEUE_SIZE = config.get('bot', {}).get('webhook_queue_size', 1000)
+# Свой адрес Bot API (локальный telegram-bot-api или фейковый сервер для тестов); пусто - api.telegram.org
+BOT_API_SERVER = config.get('bot', {}).get('api_server', "")
+
 DATABASE_URL = config.get('database', {}).get('url', "sqlite+aiosqlite:///./fishing.db")
+# Клик и покупки одним UPDATE ... RETURNING (нужен SQLite >= 3.35 или PostgreSQL)
+ATOMIC_UPDATES = config.get('database', {}).get('atomic_updates', True)
 ADSGRAM_ID = config.get('adsgram', {}).get('block_id', "")
 
+# Режим SQLite для нагрузки: WAL + PRAGMA при подключении, пул читателей и один писатель
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+SQLITE_WAL = config.get('sqlite', {}).get('wal', True)
+SQLITE_SYNCHRONOUS = config.get('sqlite', {}).get('synchronous', "NORMAL")   # в WAL NORMAL не теряет целостность
+SQLITE_BUSY_TIMEOUT = config.get('sqlite', {}).get('busy_timeout', 5000)     # мс ожидания блокировки вместо "database is locked"
+SQLITE_MMAP_SIZE = config.get('sqlite', {}).get('mmap_size', 268435456)      # байт файла БД в mmap (0 - выключить)
+SQLITE_CACHE_SIZE = config.get('sqlite', {}).get('cache_size', -65536)       # страниц, отрицательное - в КиБ
+SQLITE_READ_POOL = config.get('sqlite', {}).get('read_pool_size', 8)         # соединений для чтения
+SQLITE_SINGLE_WRITER = config.get('sqlite', {}).get('single_writer', True)   # горячие записи через одну корутину
+SQLITE_WRITER_BATCH = config.get('sqlite', {}).get('writer_batch', 256)      # запросов в одной транзакции писателя
+
+# Кэш состояния игроков (write-behind). По умолчанию выключен.
+CACHE_ENABLED = config.get('cache', {}).get('enabled', False)
+CACHE_FLUSH_INTERVAL = config.get('cache', {}).get('flush_interval', 5)   # сек. между сбросами в БД
+CACHE_MAX_PLAYERS = config.get('cache', {}).get('max_players', 10000)     # LRU-лимит записей
+CACHE_IDLE_TTL = config.get('cache', {}).get('idle_ttl', 600)             # выгружаем неактивных (сек.)
+
+# Фоновая пакетная запись уловов
+CATCH_WRITER_ENABLED = config.get('catch_writer', {}).get('enabled', True)
+CATCH_BATCH_SIZE = config.get('catch_writer', {}).get('batch_size', 500)
+CATCH_FLUSH_INTERVAL = config.get('catch_writer', {}).get('flush_interval', 1.0)
+CATCH_QUEUE_SIZE = config.get('catch_writer', {}).get('queue_size', 20000)
+CATCH_SPILL_PATH = config.get('catch_writer', {}).get('spill_path', 'catches_spill.jsonl')
+
+# Push-канал состояния (SSE) вместо опроса /api/init
+STREAM_HEARTBEAT = config.get('stream', {}).get('heartbeat', 30)  # сек. между пересчётами AFK/энергии
+
+# Метрики Prometheus на /metrics (счётчики в памяти процесса: при нескольких воркерах - у каждого свои)
+METRICS_ENABLED = config.get('metrics', {}).get('enabled', True)
+METRICS_LOOP_INTERVAL = config.get('metrics', {}).get('loop_lag_interval', 0.5)  # период замера лага event loop
+
+# Лимиты запросов в памяти процесса (у каждого воркера свои)
+RATE_LIMIT_ENABLED = config.get('rate_limit', {}).get('enabled', True)
+RATE_LIMIT_CLICK_BURST = config.get('rate_limit', {}).get('click_burst', 1)        # кликов подряд без ожидания кулдауна
+RATE_LIMIT_SHARDS = config.get('rate_limit', {}).get('shards', 16)
+RATE_LIMIT_SWEEP_INTERVAL = config.get('rate_limit', {}).get('sweep_interval', 10)  # за сколько сек. обходятся все шарды
+RATE_LIMIT_IP_ENABLED = config.get('rate_limit', {}).get('ip_enabled', False)
+RATE_LIMIT_IP_RATE = config.get('rate_limit', {}).get('ip_rate', 5)      # запросов/сек. с одного IP (/api/init, /api/leaderboard)
+RATE_LIMIT_IP_BURST = config.get('rate_limit', {}).get('ip_burst', 30)
+RATE_LIMIT_TRUST_FORWARDED = config.get('rate_limit', {}).get('trust_forwarded', False)  # IP из X-Forwarded-For (за nginx)
+
+# Хранение сырых уловов: старше keep_days сворачиваются в catch_daily (лидерборды их не читают - там score_daily)
+RETENTION_ENABLED = config.get('retention', {}).get('enabled', True)
+RETENTION_KEEP_DAYS = config.get('retention', {}).get('keep_days', 400)   # не меньше окна "year" (365 дней)
+RETENTION_MODE = config.get('retention', {}).get('mode', "delete")        # delete или archive (в catches_archive)
+RETENTION_INTERVAL = config.get('retention', {}).get('interval', 3600)    # сек. между проверками
+
+# Снимки лидерборда в памяти: один запрос к БД на (type, period) раз в ttl, а не на каждое открытие вкладки
+LEADERBOARD_TTL = config.get('leaderboard', {}).get('ttl', 10)      # сек., снимок свежий
+LEADERBOARD_STALE = config.get('leaderboard', {}).get('stale', 50)  # сек. после ttl: отдаём старый и обновляем в фоне
+# Индекс мест для /api/rank: строится из роллапов при первом запросе и пополняется при записи уловов
+RANK_ENABLED = config.get('rank', {}).get('enabled', True)
+RANK_REBUILD_INTERVAL = config.get('rank', {}).get('rebuild_interval', 600)  # сек.; сверка с БД (другие воркеры, дрейф)
+
+# Статика: результат build_static.py (хэшированные имена, WebP/AVIF, .br/.gz); без сборки - static/ как есть
+STATIC_BUILD_DIR = config.get('static', {}).get('build_dir', "static/dist")
+STATIC_MAX_AGE = config.get('static', {}).get('max_age', 31536000)  # сек. для файлов с хэшем в имени
+
+# Шаринг улова через inline-режим бота
+SHARE_CACHE_SIZE = config.get('share', {}).get('cache_size', 4096)  # готовых ответов (рыба, вес) в LRU
+SHARE_CACHE_TIME = config.get('share', {}).get('cache_time', 300)   # сек.: столько Telegram кэширует ответ у себя
+SHARE_LOG_INTERVAL = config.get('share', {}).get('log_interval', 60)  # сек.: не чаще одной строки лога
+
 Base = declarative_base()
 
 # --- МОДЕЛИ ДАННЫХ ---
@@ -63,485 +172,2163 @@ class User(Base):
     last_active_at = Column(Integer, default=lambda: int(time.time()))
     # Анти-чит: время последнего клика
     last_click_at = Column(Float, default=0.0) 
+    
+    # Итоги последнего действия (их возвращает атомарный UPDATE ... RETURNING)
+    last_bait = Column(Integer, default=0, server_default="0")  # 0 - без наживки, 1 - обычная, 2 - редкая
+    last_afk = Column(Integer, default=0, server_default="0")   # доход лодки, зачисленный последним действием
+
+# BIGINT для долгой жизни таблицы, но в SQLite первичный ключ должен быть INTEGER (alias rowid)
+CATCH_ID = BigInteger().with_variant(Integer, "sqlite")
 
 class Catch(Base):
+    """Сырой лог уловов. Рыба хранится кодом из FISH_CODES, is_trash выводится из FISH_TABLE."""
     __tablename__ = "catches"
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(BigInteger, index=True) 
-    fish_id = Column(String)                  
-    weight = Column(Float, default=0.0)       
-    is_trash = Column(Boolean, default=False)
+    id = Column(CATCH_ID, primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, nullable=False)
+    fish = Column(SmallInteger, nullable=False)
+    weight = Column(Float, default=0.0)
+    reward = Column(Integer, default=0)
+    caught_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_catches_caught_at", "caught_at"),
+        Index("ix_catches_user_caught", "user_id", "caught_at"),
+    )
+
+# Сырые уловы старше окна хранения сворачиваются сюда (см. compact_catches)
+class CatchDaily(Base):
+    __tablename__ = "catch_daily"
+    user_id = Column(BigInteger, primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    fish = Column(SmallInteger, primary_key=True)
+    count = Column(Integer, default=0)
+    weight = Column(Float, default=0.0)
+    max_weight = Column(Float, default=0.0)
+    reward = Column(BigInteger, default=0)
+
+# retention.mode: archive - сырые строки переносятся сюда, а не удаляются
+class CatchArchive(Base):
+    __tablename__ = "catches_archive"
+    id = Column(CATCH_ID, primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    fish = Column(SmallInteger, nullable=False)
+    weight = Column(Float, default=0.0)
     reward = Column(Integer, default=0)
-    caught_at = Column(DateTime, default=datetime.utcnow)
+    caught_at = Column(DateTime, nullable=False)
+
+# --- РОЛЛАПЫ ЛИДЕРБОРДА ---
+# Агрегаты обновляются при записи улова, поэтому топ не сканирует catches.
+# Поля: reward -> тип "balance", weight -> "weight" (без мусора), trash -> "trash"
+class ScoreDaily(Base):
+    __tablename__ = "score_daily"
+    user_id = Column(BigInteger, primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    reward = Column(BigInteger, default=0)
+    weight = Column(Float, default=0.0)
+    trash = Column(Integer, default=0)
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+class ScoreTotal(Base):
+    __tablename__ = "score_totals"
+    user_id = Column(BigInteger, primary_key=True)
+    reward = Column(BigInteger, default=0, index=True)
+    weight = Column(Float, default=0.0, index=True)
+    trash = Column(Integer, default=0, index=True)
+
+# Коллекция игрока: счётчики по каждой пойманной рыбе, обновляются вместе с роллапами.
+# Сырые уловы сворачиваются по сроку хранения, а эти счётчики живут всегда
+class FishStats(Base):
+    __tablename__ = "fish_stats"
+    user_id = Column(BigInteger, primary_key=True)
+    fish = Column(SmallInteger, primary_key=True)
+    count = Column(Integer, default=0)
+    weight = Column(Float, default=0.0)
+    max_weight = Column(Float, default=0.0)
+    first_caught_at = Column(DateTime, nullable=False)
+
+# Поддерживаемые счётчики (например, "players" вместо COUNT(users))
+class Counter(Base):
+    __tablename__ = "counters"
+    name = Column(String, primary_key=True)
+    value = Column(BigInteger, default=0)
+
+# Для SQLite-файла пул - это читатели (+1 соединение писателя); в памяти SQLAlchemy сам держит одно соединение
+engine_options = {"pool_size": SQLITE_READ_POOL + 1} if IS_SQLITE and ":memory:" not in DATABASE_URL else {}
+engine = create_async_engine(DATABASE_URL, echo=False, **engine_options)
+
+if IS_SQLITE:
+    @event.listens_for(engine.sync_engine, "connect")
+    def sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if SQLITE_WAL: cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT)}")
+        cursor.execute(f"PRAGMA mmap_size={int(SQLITE_MMAP_SIZE)}")
+        cursor.execute(f"PRAGMA cache_size={int(SQLITE_CACHE_SIZE)}")
+        cursor.close()
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
-# --- БАЛАНС И КОНСТАНТЫ ---
-
-# Цены на удочки (Сглаженная прогрессия)
-ROD_PRICES = {
-    1: 0, 2: 300, 3: 1000, 4: 3500, 5: 12000, 
-    6: 40000, 7: 120000, 8: 400000, 9: 1000000, 10: 3000000
-}
-
-# Цены на лодки
-BOAT_PRICES = {1: 1500, 2: 8000, 3: 35000, 4: 150000, 5: 800000}
-
-# БАЛАНС ЛОДОК (HARD NERF)
-# Доход в секунду (сильно уменьшен, чтобы не убивать активную игру)
-BOAT_INCOME = {
-    0: 0, 
-    1: 0.1,   # ~360 монет/час
-    2: 0.5,   # ~1800 монет/час
-    3: 2.5,   # ~9000 монет/час
-    4: 10.0,  # ~36k монет/час
-    5: 40.0   # ~144k монет/час
-}
-
-# ВМЕСТИМОСТЬ ТРЮМА (В часах)
-# Лодка перестает приносить доход, если игрок не заходил дольше этого времени
-BOAT_MAX_HOURS = {
-    0: 0, 
-    1: 2,   # Нужно заходить каждые 2 часа
-    2: 4,   
-    3: 8,   # Ночной режим
-    4: 12,  
-    5: 24   # Сутки
-}
-
-# Расходники
-CONSUMABLES = {
-    "energy_drink": {"price": 400, "energy": 50},  
-    "bait_common": {"price": 100, "amount": 10},   # 10 монет/шт
-    "bait_rare": {"price": 800, "amount": 5}       # 160 монет/шт
-}
-
-ENERGY_REGEN_PER_SEC = 0.6  # Полное восстановление ~2.7 минуты
-MAX_ENERGY = 100
-CLICK_COOLDOWN = 0.5        # Задержка между кликами (анти-кликер)
-
-# Таблица рыб
-FISH_TABLE = [
-    # Мусор (trash) - теперь дает небольшую награду
-    {"id": "weed", "emoji": "🌿", "mult": 0.0, "weight": 20, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
-    {"id": "boot", "emoji": "👢", "mult": 0.0, "weight": 10, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
-    {"id": "tin", "emoji": "🥫", "mult": 0.0, "weight": 10, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
-    {"id": "bone", "emoji": "☠️", "mult": 0.0, "weight": 8, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
-    {"id": "bag", "emoji": "🛍️", "mult": 0.0, "weight": 8, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
-    {"id": "tire", "emoji": "🍩", "mult": 0.0, "weight": 5, "color": "#64748b", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 0},
-    # Обычные (rarity 1)
-    {"id": "minnow", "emoji": "🐟", "mult": 1.0, "weight": 45, "color": "#fff", "is_trash": False, "min_w": 0.05, "max_w": 0.15, "rarity": 1},
-    {"id": "shrimp", "emoji": "🦐", "mult": 1.2, "weight": 40, "color": "#e2e8f0", "is_trash": False, "min_w": 0.01, "max_w": 0.05, "rarity": 1},
-    {"id": "sardine", "emoji": "🐟", "mult": 1.5, "weight": 30, "color": "#cbd5e1", "is_trash": False, "min_w": 0.1, "max_w": 0.3, "rarity": 1},
-    {"id": "carp", "emoji": "🎏", "mult": 1.8, "weight": 25, "color": "#fbbf24", "is_trash": False, "min_w": 0.5, "max_w": 2.5, "rarity": 1},
-    {"id": "perch", "emoji": "🐠", "mult": 2.0, "weight": 25, "color": "#a5f3fc", "is_trash": False, "min_w": 0.3, "max_w": 1.2, "rarity": 1},
-    {"id": "trout", "emoji": "🐟", "mult": 2.5, "weight": 20, "color": "#86efac", "is_trash": False, "min_w": 1.0, "max_w": 4.0, "rarity": 1},
-    # Редкие (rarity 2)
-    {"id": "clown", "emoji": "🤡", "mult": 3.0, "weight": 18, "color": "#f97316", "is_trash": False, "min_w": 0.1, "max_w": 0.3, "rarity": 2},
-    {"id": "crab", "emoji": "🦀", "mult": 3.5, "weight": 15, "color": "#f87171", "is_trash": False, "min_w": 1.0, "max_w": 5.0, "rarity": 2},
-    {"id": "jelly", "emoji": "🪼", "mult": 4.0, "weight": 12, "color": "#c084fc", "is_trash": False, "min_w": 0.5, "max_w": 2.0, "rarity": 2},
-    {"id": "squid", "emoji": "🦑", "mult": 5.0, "weight": 10, "color": "#f472b6", "is_trash": False, "min_w": 0.5, "max_w": 3.0, "rarity": 2},
-    {"id": "seahorse", "emoji": "🐉", "mult": 6.0, "weight": 10, "color": "#fde047", "is_trash": False, "min_w": 0.01, "max_w": 0.05, "rarity": 2},
-    {"id": "pike", "emoji": "🐊", "mult": 7.0, "weight": 8, "color": "#4ade80", "is_trash": False, "min_w": 2.0, "max_w": 12.0, "rarity": 2},
-    {"id": "eel", "emoji": "🐍", "mult": 8.0, "weight": 7, "color": "#facc15", "is_trash": False, "min_w": 1.0, "max_w": 5.0, "rarity": 2},
-    # Эпические (rarity 3)
-    {"id": "tuna", "emoji": "🐟", "mult": 12.0, "weight": 6, "color": "#60a5fa", "is_trash": False, "min_w": 20.0, "max_w": 250.0, "rarity": 3},
-    {"id": "sword", "emoji": "🗡️", "mult": 15.0, "weight": 5, "color": "#93c5fd", "is_trash": False, "min_w": 30.0, "max_w": 300.0, "rarity": 3},
-    {"id": "ray", "emoji": "👿", "mult": 20.0, "weight": 4, "color": "#818cf8", "is_trash": False, "min_w": 5.0, "max_w": 50.0, "rarity": 3},
-    {"id": "catfish", "emoji": "🐡", "mult": 25.0, "weight": 4, "color": "#d946ef", "is_trash": False, "min_w": 10.0, "max_w": 100.0, "rarity": 3},
-    {"id": "angler", "emoji": "👾", "mult": 35.0, "weight": 3, "color": "#a855f7", "is_trash": False, "min_w": 2.0, "max_w": 10.0, "rarity": 3},
-    {"id": "turtle", "emoji": "🐢", "mult": 40.0, "weight": 3, "color": "#22c55e", "is_trash": False, "min_w": 30.0, "max_w": 150.0, "rarity": 3},
-    # Легендарные (rarity 4)
-    {"id": "shark", "emoji": "🦈", "mult": 60.0, "weight": 2.5, "color": "#eab308", "is_trash": False, "min_w": 300.0, "max_w": 1500.0, "rarity": 4},
-    {"id": "whale", "emoji": "🐳", "mult": 120.0, "weight": 1.5, "color": "#3b82f6", "is_trash": False, "min_w": 2000.0, "max_w": 10000.0, "rarity": 4},
-    {"id": "chest", "emoji": "👑", "mult": 250.0, "weight": 0.5, "color": "#facc15", "is_trash": True, "min_w": 0, "max_w": 0, "rarity": 4},
-    {"id": "mega", "emoji": "🦖", "mult": 500.0, "weight": 0.2, "color": "#ef4444", "is_trash": False, "min_w": 5000.0, "max_w": 20000.0, "rarity": 4},
-    {"id": "kraken", "emoji": "🐙", "mult": 1000.0, "weight": 0.1, "color": "#dc2626", "is_trash": False, "min_w": 10000.0, "max_w": 50000.0, "rarity": 4},
-]
+# --- МЕТРИКИ (Prometheus text format) ---
+# Свои минимальные счётчики вместо prometheus_client: без зависимостей и без блокировок -
+# всё обновляется из одного event loop, наблюдение стоит одного bisect и пары сложений.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = []
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def label_text(names, values):
+    if not names: return ""
+    return "{" + ",".join(f'{n}="{label_value(v)}"' for n, v in zip(names, values)) + "}"
+
+class MetricCounter:
+    """Значение растёт через inc или читается функцией fn в момент сбора (счётчики, которые объект ведёт сам)."""
+    kind = "counter"
+    def __init__(self, name, help, labels=(), fn=None):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.fn = fn
+        METRICS.append(self)
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        if self.fn is not None:
+            value = self.fn()
+            if value is not None: yield self.name, "", value
+            return
+        for labels, value in self.values.items():
+            yield self.name, label_text(self.labels, labels), value
+
+class MetricGauge(MetricCounter):
+    """Значение выставляется явно (set) или читается функцией в момент сбора."""
+    kind = "gauge"
+
+    def set(self, *labels, value):
+        self.values[labels] = value
+
+class MetricHistogram:
+    kind = "histogram"
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}  # labels -> [счётчики по корзинам..., +Inf, сумма]
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [0] * (len(self.buckets) + 2)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self):
+        for labels, row in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row):
+                cumulative += count
+                yield self.name + "_bucket", label_text(self.labels + ("le",), labels + (bound,)), cumulative
+            yield self.name + "_sum", label_text(self.labels, labels), row[-1]
+            yield self.name + "_count", label_text(self.labels, labels), cumulative
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+def pool_stat(method):
+    # StaticPool/NullPool (например, SQLite в памяти) не считают соединения
+    def read():
+        fn = getattr(engine.sync_engine.pool, method, None)
+        return fn() if fn is not None else None
+    return read
+
+HTTP_LATENCY = MetricHistogram("fishing_http_request_duration_seconds", "Time to response start per endpoint", ("method", "endpoint", "status"))
+DB_LATENCY = MetricHistogram("fishing_db_statement_duration_seconds", "SQL statement execution time", ("operation",))
+DB_POOL_WAIT = MetricHistogram("fishing_db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection")
+MetricGauge("fishing_db_pool_in_use", "Connections checked out of the pool", fn=pool_stat("checkedout"))
+MetricGauge("fishing_db_pool_idle", "Idle connections in the pool", fn=pool_stat("checkedin"))
+MetricGauge("fishing_db_pool_overflow", "Connections above pool_size", fn=pool_stat("overflow"))
+CLICKS = MetricCounter("fishing_clicks_total", "Click outcomes of /api/fish", ("status",))
+CATCHES = MetricCounter("fishing_catches_total", "Catches by FISH_TABLE rarity", ("rarity",))
+LEADERBOARD_CACHE = MetricCounter("fishing_leaderboard_cache_total", "Leaderboard snapshot lookups", ("result",))
+RATE_LIMITED = MetricCounter("fishing_rate_limited_total", "Requests rejected in memory before any DB access", ("limiter",))
+INLINE_SHARES = MetricCounter("fishing_inline_share_total", "Inline share queries by result cache outcome", ("result",))
+LOOP_LAG = MetricHistogram("fishing_event_loop_lag_seconds", "Event loop scheduling delay", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+BOT_LATENCY = MetricHistogram("fishing_bot_update_duration_seconds", "aiogram update handling time", ("type",))
+# Очереди фоновых писателей (объекты создаются ниже, читаются в момент сбора)
+MetricGauge("fishing_catch_queue_depth", "Catches waiting for the batch writer", fn=lambda: catch_writer.depth() if catch_writer else None)
+MetricGauge("fishing_catch_queue_max_depth", "Deepest catch queue seen", fn=lambda: catch_writer.stats["max_depth"] if catch_writer else None)
+MetricCounter("fishing_catch_queue_blocked_total", "Requests that waited for room in a full catch queue", fn=lambda: catch_writer.stats["blocked"] if catch_writer else None)
+MetricCounter("fishing_catch_writer_written_total", "Catches written by the batch writer", fn=lambda: catch_writer.stats["written"] if catch_writer else None)
+MetricCounter("fishing_catch_writer_failed_total", "Catches whose batch failed all retries (spilled to disk)", fn=lambda: catch_writer.stats["failed"] if catch_writer else None)
+MetricCounter("fishing_catch_writer_replayed_total", "Spilled catches written after the database recovered", fn=lambda: catch_writer.stats["replayed"] if catch_writer else None)
+MetricGauge("fishing_sqlite_writer_queue", "Writes waiting for the SQLite writer", fn=lambda: sqlite_writer.queue.qsize() if sqlite_writer else None)
+MetricGauge("fishing_player_cache_size", "Players held in the write-behind cache", fn=lambda: len(player_cache.players) if player_cache else None)
+
+if METRICS_ENABLED:
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def metrics_statement_start(conn, cursor, statement, parameters, context, executemany):
+        conn.info["metrics_started"] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def metrics_statement_end(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("metrics_started", None)
+        if started is None: return
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_LATENCY.observe(time.perf_counter() - started, operation)
+
+    def instrument_pool(pool):
+        """Время ожидания свободного соединения: обёртка над получением соединения пулом."""
+        get = pool._do_get
+        def timed_get():
+            started = time.perf_counter()
+            try:
+                return get()
+            finally:
+                DB_POOL_WAIT.observe(time.perf_counter() - started)
+        pool._do_get = timed_get
+
+    instrument_pool(engine.sync_engine.pool)
+
+class MetricsMiddleware:
+    """ASGI-middleware: время до начала ответа (для SSE - до первого байта, а не всего потока)."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                route = scope.get("route")
+                endpoint = route.path if route is not None else ("/static" if scope["path"].startswith("/static") else "other")
+                HTTP_LATENCY.observe(time.perf_counter() - started, scope["method"], endpoint, message["status"])
+            await send(message)
+        await self.app(scope, receive, send_timed)
+
+async def watch_loop_lag(interval):
+    """Насколько позже запланированного просыпается задача - задержка всего event loop."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
+
+# --- ОТВЕТЫ ИГРОВОГО API ---
+# Баланс, таблица рыб и формулы - в game_rules.py (общие с симулятором simulate.py)
+# Протокол 2: статичное (эмодзи, цвета, цены, adsgram_id) клиент один раз берёт из /api/catalog,
+# в ответах остаются id рыбы и изменившиеся поля. Клиент без "v" получает прежний формат.
+PROTOCOL_VERSION = 2
+
+def game_json(content):
+    if orjson is not None: return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+class GameJSONResponse(Response):
+    """JSON игрового API: orjson, если установлен, и без прохода через jsonable_encoder."""
+    media_type = "application/json"
+
+    def render(self, content):
+        return game_json(content)
+
+def compact_state(state, protocol=1):
+    # Протокол 2: цены следующих уровней клиент знает из /api/catalog
+    if protocol < 2: return state
+    return {k: v for k, v in state.items() if k not in ("rod_price", "boat_price")}
+
+def click_response(status, user, afk_earned, used_bait=None, protocol=1):
+    if protocol >= 2:
+        response = {"status": status, "balance": user.balance, "energy": int(user.energy)}
+        if afk_earned: response["afk_earned"] = afk_earned
+        # Из наживок - только потраченная этим кликом
+        if used_bait: response[f"bait_{used_bait}"] = getattr(user, f"bait_{used_bait}")
+        return response
+
+    response = {
+        "status": status, 
+        "balance": user.balance, 
+        "energy": int(user.energy), 
+        "afk_earned": afk_earned
+    }
+    if status in ("miss", "caught"):
+        response["bait_common"] = user.bait_common
+        response["bait_rare"] = user.bait_rare
+    return response
+
+def catch_response(fish, weight, reward, user, afk_earned, used_bait=None, protocol=1):
+    if protocol >= 2:
+        return {**click_response("caught", user, afk_earned, used_bait, protocol),
+                "fish_id": fish['id'], "reward": reward, "weight": weight}
+
+    return {
+        "status": "caught", 
+        "fish_id": fish['id'], "fish_emoji": fish['emoji'], "fish_color": fish['color'],
+        "reward": reward, "weight": weight, "is_trash": fish['is_trash'],
+        "rarity": fish.get('rarity', 1), # Добавили редкость для шаринга
+        "balance": user.balance, "energy": int(user.energy), 
+        "afk_earned": afk_earned,
+        "bait_common": user.bait_common,
+        "bait_rare": user.bait_rare
+    }
 
 class ClickRequest(BaseModel):
     telegram_id: int
+    v: int = 1  # версия протокола ответа
 class InitRequest(BaseModel):
     telegram_id: int
+    v: int = 1
+    sync: bool = False  # периодическая синхронизация клиента: только чтение
     username: str | None = None
     first_name: str | None = None
     last_name: str | None = None
 class BuyRequest(BaseModel):
     telegram_id: int
     item_id: str
+    v: int = 1
 class AdRewardRequest(BaseModel):
     telegram_id: int
 
-# --- ЛОГИКА ОФФЛАЙН ПРОГРЕССА С ЛИМИТАМИ ---
-def calculate_offline_progress(user, current_time, is_active=False):
-    time_diff = current_time - user.last_active_at
-    if time_diff < 0: time_diff = 0
-    
-    # 1. Лимит по времени работы лодки (вместимость трюма)
-    max_hours = BOAT_MAX_HOURS.get(user.boat_level, 0)
-    max_seconds = max_hours * 3600
-    effective_time = min(time_diff, max_seconds)
-    
-    # 2. Начисление денег за эффективное время
-    income = BOAT_INCOME.get(user.boat_level, 0)
-    earned = int(effective_time * income)
-    user.balance += earned
-    
-    # 3. Восстановление энергии (за ВСЁ время отсутствия, тут лимит лодки не влияет)
-    if not is_active or time_diff > 5:
-        restored_energy = time_diff * ENERGY_REGEN_PER_SEC
-        user.energy = min(MAX_ENERGY, user.energy + restored_energy)
-    
-    user.last_active_at = current_time
-    return earned
+# --- КЭШ СОСТОЯНИЯ ИГРОКОВ (WRITE-BEHIND) ---
+# Горячие поля активных игроков живут в памяти, в таблицу users уходят пачками.
+# Работает только при одном процессе: несколько воркеров не видят кэши друг друга.
+PLAYER_FIELDS = (
+    "username", "first_name", "last_name", "balance", "energy",
+    "rod_level", "boat_level", "bait_common", "bait_rare",
+    "last_active_at", "last_click_at"
+)
+
+class PlayerState:
+    """Копия строки users в памяти. По полям совместима с ORM User."""
+    __slots__ = ("telegram_id", "touched_at") + PLAYER_FIELDS
+
+    def __init__(self, user):
+        self.telegram_id = user.telegram_id
+        for field in PLAYER_FIELDS:
+            setattr(self, field, getattr(user, field))
+        self.touched_at = time.monotonic()
+
+    def as_row(self):
+        row = {field: getattr(self, field) for field in PLAYER_FIELDS}
+        row["telegram_id"] = self.telegram_id
+        return row
+
+class PlayerCache:
+    def __init__(self, max_players, idle_ttl):
+        self.max_players = max_players
+        self.idle_ttl = idle_ttl
+        self.players = OrderedDict()   # telegram_id -> PlayerState, порядок = LRU
+        self.dirty = {}                # telegram_id -> PlayerState, ждут записи в БД
+        self._loading = {}             # telegram_id -> Task (одна загрузка на игрока)
+        self._flush_lock = asyncio.Lock()
+
+    async def get(self, telegram_id):
+        state = self.players.get(telegram_id)
+        if state is not None:
+            self.players.move_to_end(telegram_id)
+            state.touched_at = time.monotonic()
+            return state
+
+        # Параллельные запросы одного игрока ждут одну и ту же загрузку
+        task = self._loading.get(telegram_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(telegram_id))
+            self._loading[telegram_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(telegram_id, None))
+        return await task
+
+    async def _load(self, telegram_id):
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(select(User).where(User.telegram_id == telegram_id))
+            user = result.scalars().first()
+        if not user: return None
+        return self.put(user)
+
+    def put(self, user):
+        state = PlayerState(user)
+        self.players[state.telegram_id] = state
+        self._trim()
+        return state
+
+    def mark_dirty(self, state):
+        self.dirty[state.telegram_id] = state
+
+    def _trim(self):
+        # Выгружаем самых старых чистых игроков сверх лимита (грязные дождутся сброса)
+        excess = len(self.players) - self.max_players
+        if excess <= 0: return
+        for telegram_id in list(self.players):
+            if excess <= 0: break
+            if telegram_id not in self.dirty:
+                del self.players[telegram_id]
+                excess -= 1
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_ttl
+        for telegram_id, state in list(self.players.items()):
+            if state.touched_at >= deadline: break  # дальше по LRU только более свежие
+            if telegram_id not in self.dirty:
+                del self.players[telegram_id]
+        self._trim()
+
+    async def flush(self, telegram_ids=None):
+        """Пишет грязные записи одним пакетным UPDATE. Возвращает число строк."""
+        async with self._flush_lock:
+            if telegram_ids is None:
+                batch = self.dirty
+                self.dirty = {}
+            else:
+                batch = {tid: self.dirty.pop(tid) for tid in telegram_ids if tid in self.dirty}
+            if not batch: return 0
+
+            # Снимок значений делаем до await, чтобы не писать полуизменённые записи
+            rows = [state.as_row() for state in batch.values()]
+            async def job(conn):
+                async with AsyncSession(bind=conn) as session:
+                    await session.execute(update(User), rows)
+            try:
+                await write_job(job)
+            except Exception:
+                # Не теряем изменения: вернём в очередь (свежие правки не перетираем)
+                for telegram_id, state in batch.items():
+                    self.dirty.setdefault(telegram_id, state)
+                raise
+            return len(rows)
+
+    async def run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Cache flush error: {e}")
+            self.evict_idle()
+
+player_cache = PlayerCache(CACHE_MAX_PLAYERS, CACHE_IDLE_TTL) if CACHE_ENABLED else None
+
+@asynccontextmanager
+async def open_player(telegram_id):
+    """Отдаёт игрока (PlayerState из кэша или ORM User) и сохраняет изменения на выходе."""
+    if player_cache is not None:
+        user = await player_cache.get(telegram_id)
+        before = user.as_row() if user is not None else None
+        yield user
+        # Только чтение (например, опрос /api/init) не делает запись грязной
+        if user is not None and user.as_row() != before: player_cache.mark_dirty(user)
+        return
+
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(User).where(User.telegram_id == telegram_id))
+        user = result.scalars().first()
+        yield user
+        if sqlite_writer is None:
+            await session.commit()
+            return
+        # Писатель SQLite: читающую транзакцию закрываем, изменённые поля уходят ему одним UPDATE
+        changes = {} if user is None else {attr.key: attr.value for attr in inspect(user).attrs if attr.history.has_changes()}
+        await session.close()
+    if changes:
+        stmt = update(User.__table__).where(User.__table__.c.telegram_id == telegram_id).values(**changes)
+        await write_job(lambda conn: conn.execute(stmt))
+
+SCORE_FIELDS = ("reward", "weight", "trash")
+
+def upsert_add(model, keys, values):
+    """INSERT ... ON CONFLICT DO UPDATE SET col = col + excluded.col (SQLite и PostgreSQL).
+    Параметры передаются при execute: словарь или список словарей (executemany)."""
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    table = model.__table__
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={name: table.c[name] + stmt.excluded[name] for name in values}
+    )
+
+async def create_player(user):
+    """Новый игрок пишется в БД сразу (write-through), затем попадает в кэш."""
+    async def job(conn):
+        # Группа писателя могла откатиться и повторяться: снова вставляем, а не считаем объект сохранённым
+        make_transient(user)
+        async with AsyncSession(bind=conn, expire_on_commit=False) as session:
+            session.add(user)
+            await session.flush()
+        await conn.execute(upsert_add(Counter, ["name"], ["value"]), {"name": "players", "value": 1})
+
+    try:
+        await write_job(job)
+    except IntegrityError:
+        # Параллельный /api/init (например, из другого воркера) уже создал игрока
+        user = await load_user(user.telegram_id)
+    if player_cache is not None:
+        return player_cache.put(user)
+    return user
+
+# --- SQLITE: ЕДИНСТВЕННЫЙ ПИСАТЕЛЬ ---
+# SQLite пишет только одной транзакцией за раз: параллельные коммиты лишь ждут друг друга на
+# блокировке. Вместо этого все записи (клик, покупка, пачка уловов, новый игрок, сброс кэша,
+# свёртка уловов) встают в очередь, и одна корутина выполняет всё накопившееся одной транзакцией -
+# один коммит на группу, а не на запрос. Исключение - init_db: он работает до старта писателя и запросов.
+class SqliteWriter:
+    def __init__(self, max_batch):
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self._task = None
+        self.stats = {"jobs": 0, "groups": 0, "max_group": 0, "split": 0}
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def run(self, job):
+        """job(conn) - корутина с запросами; результат отдаётся после коммита группы."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, future))
+        return await future
+
+    async def execute(self, stmt, params=None):
+        async def job(conn):
+            return (await conn.execute(stmt, params)).first()
+        return await self.run(job)
+
+    async def close(self):
+        if self._task is None or self._task.done(): return
+        await self.queue.put(None)
+        await self._task
+
+    async def _run(self):
+        stop, group = False, []
+        try:
+            while not stop:
+                item = await self.queue.get()
+                if item is None: break
+                group = [item]
+                while len(group) < self.max_batch:
+                    try:
+                        item = self.queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    group.append(item)
+                await self._commit(group)
+        finally:
+            # Писатель остановлен (в т.ч. отменой): ждущие запросы получают ошибку, а не висят вечно
+            pending = [future for _, future in group]
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is not None: pending.append(item[1])
+            for future in pending:
+                if not future.done(): future.set_exception(RuntimeError("SQLite writer stopped"))
+
+    async def _commit(self, group):
+        try:
+            async with engine.begin() as conn:
+                results = [await job(conn) for job, _ in group]
+        except Exception as e:
+            if len(group) > 1:
+                # Ошибка одного запроса откатила всю группу - повторяем по одному, остальные пройдут
+                self.stats["split"] += 1
+                for item in group: await self._commit([item])
+                return
+            if not group[0][1].done(): group[0][1].set_exception(e)
+            return
+        self.stats["jobs"] += len(group)
+        self.stats["groups"] += 1
+        self.stats["max_group"] = max(self.stats["max_group"], len(group))
+        for (_, future), result in zip(group, results):
+            if not future.done(): future.set_result(result)
+
+sqlite_writer = SqliteWriter(SQLITE_WRITER_BATCH) if IS_SQLITE and SQLITE_SINGLE_WRITER else None
+
+async def write_job(job):
+    """job(conn) в транзакции записи: через писателя SQLite, если он включён, иначе своей транзакцией."""
+    if sqlite_writer is not None:
+        return await sqlite_writer.run(job)
+    async with engine.begin() as conn:
+        return await job(conn)
+
+async def write_catches(rows):
+    """Пакетная запись уловов: один executemany в catches + агрегированные апсерты роллапов."""
+    daily, totals, fish_stats = {}, {}, {}
+    for row in rows:
+        user_id, day = row["user_id"], row["caught_at"].date()
+        is_trash = FISH_BY_CODE[row["fish"]]['is_trash']
+        weight = 0.0 if is_trash else row["weight"]
+        trash = 1 if is_trash else 0
+        for acc in (
+            daily.setdefault((user_id, day), {"user_id": user_id, "day": day, "reward": 0, "weight": 0.0, "trash": 0}),
+            totals.setdefault(user_id, {"user_id": user_id, "reward": 0, "weight": 0.0, "trash": 0}),
+        ):
+            acc["reward"] += row["reward"]
+            acc["weight"] += weight
+            acc["trash"] += trash
+        stats = fish_stats.setdefault((user_id, row["fish"]), {
+            "user_id": user_id, "fish": row["fish"], "count": 0, "weight": 0.0, "max_weight": 0.0,
+            "first_caught_at": row["caught_at"]
+        })
+        stats["count"] += 1
+        stats["weight"] += row["weight"]
+        stats["max_weight"] = max(stats["max_weight"], row["weight"])
+        stats["first_caught_at"] = min(stats["first_caught_at"], row["caught_at"])
+
+    async def job(conn):
+        await conn.execute(Catch.__table__.insert(), rows)
+        await conn.execute(upsert_add(ScoreDaily, ["user_id", "day"], SCORE_FIELDS), list(daily.values()))
+        await conn.execute(upsert_add(ScoreTotal, ["user_id"], SCORE_FIELDS), list(totals.values()))
+        stmt, set_ = fish_stats_upsert()
+        await conn.execute(stmt.on_conflict_do_update(index_elements=["user_id", "fish"], set_=set_), list(fish_stats.values()))
+        if rank_board is not None:
+            # Номер пачки в порядке коммитов: по нему RankBoard отличает пачки, уже попавшие в снимок
+            stmt = upsert_add(Counter, ["name"], ["value"]).returning(Counter.value)
+            return (await conn.execute(stmt, {"name": RANK_SEQ_COUNTER, "value": 1})).scalar()
+
+    seq = await write_job(job)
+    if rank_board is not None: rank_board.record(seq, list(daily.values()))
+
+# --- ФОНОВАЯ ЗАПИСЬ УЛОВОВ ---
+# fish_action только кладёт улов в очередь, INSERT делается пачками вне запроса.
+# Баланс за улов уже начислен, поэтому пачка, не записанная после всех попыток, не выбрасывается:
+# она дописывается в spill-файл (JSON lines) и повторяется, как только очередная пачка запишется.
+class CatchWriter:
+    def __init__(self, batch_size, flush_interval, queue_size, spill_path):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._full = asyncio.Event()
+        self._task = None
+        self._spilled = os.path.exists(spill_path)  # остался с прошлого запуска
+        # Метрики очереди (backpressure)
+        self.stats = {
+            "enqueued": 0, "written": 0, "batches": 0,
+            "failed": 0,         # уловы из пачек, не записанных за все попытки (ушли в spill-файл)
+            "replayed": 0,       # уловы, дописанные из spill-файла
+            "blocked": 0,        # сколько раз запрос ждал места в заполненной очереди
+            "max_depth": 0, "last_batch": 0, "last_flush_ms": 0.0
+        }
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def depth(self):
+        return self.queue.qsize()
+
+    async def submit(self, row):
+        self.start()
+        if self.queue.full():
+            self.stats["blocked"] += 1
+            logging.warning("Catch queue is full, request is waiting for the writer")
+        await self.queue.put(row)
+        self.stats["enqueued"] += 1
+        depth = self.queue.qsize()
+        if depth > self.stats["max_depth"]: self.stats["max_depth"] = depth
+        if depth >= self.batch_size: self._full.set()
+
+    async def close(self):
+        """Дожидается записи всего, что уже в очереди (вызывается при остановке)."""
+        if self._task is None or self._task.done(): return
+        await self.queue.put(None)  # сигнал остановки
+        self._full.set()
+        await self._task
+
+    async def _run(self):
+        if self._spilled: await self._guard(self._replay())
+        while True:
+            first = await self.queue.get()
+            batch = [] if first is None else [first]
+            stop = first is None
+
+            # Ждём, пока наберётся пачка или истечёт интервал
+            if not stop and self.queue.qsize() + 1 < self.batch_size:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            while not stop and len(batch) < self.batch_size:
+                try:
+                    row = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if row is None: stop = True
+                else: batch.append(row)
+
+            if batch: await self._guard(self._write(batch))
+            if stop and self.queue.empty(): return
+
+    async def _guard(self, job):
+        # Ошибка одной пачки или повтора не должна останавливать писателя: иначе очередь больше не разгружается
+        try:
+            await job
+        except Exception as e:
+            logging.exception(f"Catch writer error: {e}")
+
+    async def _write(self, batch):
+        started = time.perf_counter()
+        for attempt in range(1, 4):
+            try:
+                await write_catches(batch)
+                break
+            except Exception as e:
+                logging.error(f"Catch batch write error (attempt {attempt}): {e}")
+                if attempt == 3:
+                    self.stats["failed"] += len(batch)
+                    self._spill(batch)
+                    return
+                await asyncio.sleep(attempt)
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["last_batch"] = len(batch)
+        self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        # БД снова принимает записи - дописываем отложенное
+        if self._spilled: await self._replay()
+
+    def _spill(self, batch):
+        lines = "".join(json.dumps({**row, "caught_at": row["caught_at"].isoformat()}) + "\n" for row in batch)
+        try:
+            with open(self.spill_path, "a") as f:
+                f.write(lines)
+        except OSError as e:
+            logging.error(f"Catch spill error, {len(batch)} catches lost: {e}")
+            return
+        self._spilled = True
+        logging.error(f"{len(batch)} catches spilled to {self.spill_path}")
+
+    async def _replay(self):
+        # Файл забираем переименованием до первой записи: новые сбои (в том числе других воркеров
+        # с тем же spill_path) пишутся уже в свежий spill-файл и не теряются между чтением и удалением
+        self._spilled = False
+        claimed = f"{self.spill_path}.{os.getpid()}"
+        try:
+            os.replace(self.spill_path, claimed)
+        except FileNotFoundError:
+            return  # забрал другой воркер
+        rows, bad = [], []
+        with open(claimed) as f:
+            for line in f:
+                if not line.strip(): continue
+                try:
+                    rows.append(parse_spilled_catch(line))
+                except (ValueError, KeyError, TypeError):
+                    bad.append(line if line.endswith("\n") else line + "\n")
+        if bad:
+            # Недописанная строка (например, после переполнения диска) не должна блокировать остальные
+            with open(f"{self.spill_path}.bad", "a") as f:
+                f.write("".join(bad))
+            logging.error(f"{len(bad)} malformed spilled catches moved to {self.spill_path}.bad")
+        os.remove(claimed)
+
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            try:
+                await write_catches(batch)
+            except Exception as e:
+                logging.error(f"Catch replay error: {e}")
+                self._spill(rows[start:])
+                return
+            self.stats["replayed"] += len(batch)
+        if rows: logging.info(f"{len(rows)} spilled catches written")
+
+def parse_spilled_catch(line):
+    """Строка spill-файла -> улов для write_catches; ValueError/KeyError/TypeError на битой строке."""
+    data = json.loads(line)
+    row = {
+        "user_id": int(data["user_id"]), "fish": int(data["fish"]),
+        "weight": float(data["weight"]), "reward": int(data["reward"]),
+        "caught_at": datetime.fromisoformat(data["caught_at"])
+    }
+    if row["fish"] not in FISH_BY_CODE: raise KeyError(row["fish"])
+    return row
+
+catch_writer = CatchWriter(CATCH_BATCH_SIZE, CATCH_FLUSH_INTERVAL, CATCH_QUEUE_SIZE, CATCH_SPILL_PATH) if CATCH_WRITER_ENABLED else None
+
+async def record_catch(row):
+    row.setdefault("caught_at", datetime.utcnow())
+    if catch_writer is not None:
+        await catch_writer.submit(row)
+    else:
+        await write_catches([row])
+
+# Колонки, добавленные после первого релиза: create_all не меняет существующие таблицы
+ADDED_COLUMNS = [User.__table__.c.last_bait, User.__table__.c.last_afk]
+
+async def migrate_schema(conn):
+    def missing_columns(sync_conn):
+        inspector = inspect(sync_conn)
+        result = []
+        for added in ADDED_COLUMNS:
+            existing = {col["name"] for col in inspector.get_columns(added.table.name)}
+            if added.name not in existing: result.append(added)
+        return result
+
+    for added in await conn.run_sync(missing_columns):
+        column_type = added.type.compile(dialect=conn.dialect)
+        default = f" DEFAULT {added.server_default.arg}" if added.server_default is not None else ""
+        await conn.execute(text(f"ALTER TABLE {added.table.name} ADD COLUMN {added.name} {column_type}{default}"))
+        logging.info(f"Schema migrated: added {added.table.name}.{added.name}")
+
+async def migrate_catches(conn):
+    """Старая схема catches (fish_id строкой + is_trash, индекс только по user_id) -> компактная.
+    Вызывается до create_all: старая таблица переименовывается, новая создаётся, строки копируются."""
+    def legacy_columns(sync_conn):
+        inspector = inspect(sync_conn)
+        if "catches" not in inspector.get_table_names(): return set()
+        return {col["name"] for col in inspector.get_columns("catches")}
+
+    if "fish_id" not in await conn.run_sync(legacy_columns): return
+
+    await conn.execute(text("ALTER TABLE catches RENAME TO catches_legacy"))
+    if conn.dialect.name == "postgresql":
+        # Имена индексов и последовательностей в PostgreSQL общие на схему - освобождаем их для новой таблицы
+        await conn.execute(text("ALTER INDEX IF EXISTS catches_pkey RENAME TO catches_legacy_pkey"))
+        await conn.execute(text("ALTER SEQUENCE IF EXISTS catches_id_seq RENAME TO catches_legacy_id_seq"))
+    await conn.run_sync(Catch.__table__.create)
+
+    legacy = table("catches_legacy", column("id"), column("user_id"), column("fish_id"),
+                   column("weight"), column("reward"), column("caught_at"))
+    await conn.execute(Catch.__table__.insert().from_select(
+        ["id", "user_id", "fish", "weight", "reward", "caught_at"],
+        select(
+            legacy.c.id, legacy.c.user_id,
+            case(FISH_CODES, value=legacy.c.fish_id, else_=UNKNOWN_FISH_CODE),
+            func.coalesce(legacy.c.weight, 0.0), func.coalesce(legacy.c.reward, 0),
+            func.coalesce(legacy.c.caught_at, datetime.utcnow())
+        ).where(legacy.c.user_id.isnot(None))
+    ))
+    if conn.dialect.name == "postgresql":
+        await conn.execute(text("SELECT setval(pg_get_serial_sequence('catches', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM catches"))
+    copied = await conn.scalar(select(func.count()).select_from(Catch))
+    await conn.execute(text("DROP TABLE catches_legacy"))
+    logging.info(f"Schema migrated: catches converted to fish codes ({copied} rows)")
+
+async def backfill_rollups(conn):
+    """Разовое заполнение роллапов из истории catches (для уже существующих баз)."""
+    done = await conn.scalar(select(Counter.value).where(Counter.name == "players"))
+    if done is not None: return
+
+    day = func.date(Catch.caught_at)
+    is_trash = Catch.fish.in_(TRASH_CODES)
+    weight = func.sum(case((is_trash, 0.0), else_=Catch.weight))
+    trash = func.sum(case((is_trash, 1), else_=0))
+    await conn.execute(ScoreDaily.__table__.insert().from_select(
+        ["user_id", "day", "reward", "weight", "trash"],
+        select(Catch.user_id, day, func.sum(Catch.reward), weight, trash).group_by(Catch.user_id, day)
+    ))
+    await conn.execute(ScoreTotal.__table__.insert().from_select(
+        ["user_id", "reward", "weight", "trash"],
+        select(Catch.user_id, func.sum(Catch.reward), weight, trash).group_by(Catch.user_id)
+    ))
+    players = await conn.scalar(select(func.count(User.telegram_id)))
+    await conn.execute(Counter.__table__.insert().values(name="players", value=players or 0))
+    logging.info(f"Leaderboard rollups backfilled ({players} players)")
+
+async def backfill_fish_stats(conn):
+    """Разовое заполнение коллекций: свёрнутая история из catch_daily плюс сырые catches."""
+    if await conn.scalar(select(FishStats.user_id).limit(1)) is not None: return
+    if await conn.scalar(select(Catch.id).limit(1)) is None and \
+       await conn.scalar(select(CatchDaily.user_id).limit(1)) is None: return
+
+    columns = ["user_id", "fish", "count", "weight", "max_weight", "first_caught_at"]
+    await conn.execute(FishStats.__table__.insert().from_select(columns, select(
+        CatchDaily.user_id, CatchDaily.fish, func.sum(CatchDaily.count), func.sum(CatchDaily.weight),
+        func.max(CatchDaily.max_weight), func.min(CatchDaily.day)
+    ).group_by(CatchDaily.user_id, CatchDaily.fish)))
+    stmt, set_ = fish_stats_upsert()
+    await conn.execute(stmt.from_select(columns, select(
+        Catch.user_id, Catch.fish, func.count(), func.sum(Catch.weight),
+        func.max(Catch.weight), func.min(Catch.caught_at)
+    ).group_by(Catch.user_id, Catch.fish)).on_conflict_do_update(index_elements=["user_id", "fish"], set_=set_))
+    rows = await conn.scalar(select(func.count()).select_from(FishStats))
+    logging.info(f"Fish collections backfilled ({rows} rows)")
+
+# --- ХРАНЕНИЕ УЛОВОВ: СВОРАЧИВАНИЕ СТАРЫХ СЫРЫХ ЗАПИСЕЙ ---
+
+def catch_daily_upsert():
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    t = CatchDaily.__table__
+    stmt = insert(t)
+    return stmt, {
+        "count": t.c.count + stmt.excluded.count,
+        "weight": t.c.weight + stmt.excluded.weight,
+        "reward": t.c.reward + stmt.excluded.reward,
+        "max_weight": case((stmt.excluded.max_weight > t.c.max_weight, stmt.excluded.max_weight), else_=t.c.max_weight),
+    }
+
+def fish_stats_upsert():
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    t = FishStats.__table__
+    stmt = insert(t)
+    return stmt, {
+        "count": t.c.count + stmt.excluded.count,
+        "weight": t.c.weight + stmt.excluded.weight,
+        "max_weight": case((stmt.excluded.max_weight > t.c.max_weight, stmt.excluded.max_weight), else_=t.c.max_weight),
+        "first_caught_at": case((stmt.excluded.first_caught_at < t.c.first_caught_at, stmt.excluded.first_caught_at), else_=t.c.first_caught_at),
+    }
+
+async def compact_catches(now=None):
+    """Уловы старше RETENTION_KEEP_DAYS по одному дню за транзакцию: агрегат (игрок, день, рыба)
+    в catch_daily, затем сырые строки удаляются или переносятся в catches_archive."""
+    now = now or datetime.utcnow()
+    cutoff = datetime.combine(now.date() - timedelta(days=RETENTION_KEEP_DAYS), datetime.min.time())
+    async def compact_day(conn):
+        # Один день за транзакцию: писатель SQLite не занят надолго, клики проходят между днями
+        if conn.dialect.name == "postgresql":
+            # Другой воркер уже сворачивает - не мешаем
+            if not await conn.scalar(text("SELECT pg_try_advisory_xact_lock(724202)")): return None
+        first = await conn.scalar(select(func.min(Catch.caught_at)).where(Catch.caught_at < cutoff))
+        if first is None: return None
+
+        day_start = datetime.combine(first.date(), datetime.min.time())
+        in_day = (Catch.caught_at >= day_start) & (Catch.caught_at < min(day_start + timedelta(days=1), cutoff))
+        stmt, set_ = catch_daily_upsert()
+        await conn.execute(stmt.from_select(
+            ["user_id", "day", "fish", "count", "weight", "max_weight", "reward"],
+            select(Catch.user_id, literal(day_start.date(), Date), Catch.fish, func.count(),
+                   func.sum(Catch.weight), func.max(Catch.weight), func.sum(Catch.reward))
+            .where(in_day).group_by(Catch.user_id, Catch.fish)
+        ).on_conflict_do_update(index_elements=["user_id", "day", "fish"], set_=set_))
+        if RETENTION_MODE == "archive":
+            columns = ["id", "user_id", "fish", "weight", "reward", "caught_at"]
+            await conn.execute(CatchArchive.__table__.insert().from_select(
+                columns, select(*(Catch.__table__.c[name] for name in columns)).where(in_day)
+            ))
+        result = await conn.execute(delete(Catch).where(in_day))
+        return result.rowcount
+
+    days = rows = 0
+    while True:
+        deleted = await write_job(compact_day)
+        if deleted is None: break
+        days += 1
+        rows += deleted
+        await asyncio.sleep(0)
+    if days: logging.info(f"Catches compacted: {rows} rows from {days} days ({RETENTION_MODE})")
+    return rows
+
+async def run_retention(interval):
+    while True:
+        try:
+            await compact_catches()
+        except Exception as e:
+            logging.error(f"Catch retention error: {e}")
+        await asyncio.sleep(interval)
+
+def player_state(user):
+    """Общая часть ответа о состоянии игрока (init, upgrade, push-канал)."""
+    return {
+        "balance": user.balance, 
+        "energy": int(user.energy),
+        "rod_level": user.rod_level, 
+        "boat_level": user.boat_level,
+        "rod_price": upgrade_price("rod", user.rod_level), 
+        "boat_price": upgrade_price("boat", user.boat_level),
+        "bait_common": user.bait_common,
+        "bait_rare": user.bait_rare
+    }
+
+def observe_player(user, current_time):
+    """Состояние на момент current_time без записи в БД: доход лодки и энергия
+    считаются из last_active_at. Когда трюм заполнился, доход фиксирует settle_player."""
+    earned, _ = offline_progress(user, current_time)
+    return projected_state(user, current_time), earned
+
+def projected_state(user, current_time, is_active=False):
+    earned, energy = offline_progress(user, current_time, is_active)
+    return {**player_state(user), "balance": user.balance + earned, "energy": int(energy)}
+
+# --- PUSH-КАНАЛ (SSE) ---
+# Подписчики живут в памяти процесса; между воркерами изменения доходят через heartbeat.
+class PlayerEvents:
+    def __init__(self):
+        self.subscribers = {}  # telegram_id -> set(asyncio.Queue)
+
+    def subscribe(self, telegram_id):
+        queue = asyncio.Queue(maxsize=8)
+        self.subscribers.setdefault(telegram_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, telegram_id, queue):
+        queues = self.subscribers.get(telegram_id)
+        if not queues: return
+        queues.discard(queue)
+        if not queues: del self.subscribers[telegram_id]
+
+    def publish(self, telegram_id, payload):
+        for queue in self.subscribers.get(telegram_id, ()):
+            if queue.full():
+                queue.get_nowait()  # медленному клиенту нужен только последний снимок
+            queue.put_nowait(payload)
+
+player_events = PlayerEvents()
+
+# --- АТОМАРНЫЙ ПУТЬ: ОДИН UPDATE ... RETURNING НА ДЕЙСТВИЕ ---
+# Без кэша игроков клик и покупка - один условный UPDATE: проверки (кулдаун, энергия,
+# цена) стоят в WHERE, изменения считает сама БД. Гонки двух запросов одного игрока
+# (в т.ч. из разных воркеров) не теряют обновлений. Случайность бросаем заранее.
+if ATOMIC_UPDATES and not CACHE_ENABLED and DATABASE_URL.startswith("sqlite") and sqlite3.sqlite_version_info < (3, 35):
+    logging.warning("SQLite < 3.35 has no RETURNING, atomic updates are disabled")
+    ATOMIC_UPDATES = False
+ATOMIC_UPDATES = ATOMIC_UPDATES and not CACHE_ENABLED
+
+# Одиночный UPDATE в autocommit: без отдельных BEGIN/COMMIT
+atomic_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+users = User.__table__
+
+def sql_least(a, b):
+    return case((a < b, a), else_=b)
+
+def sql_int(expr):
+    # int() в Python отбрасывает дробь; CAST в PostgreSQL округляет, поэтому trunc
+    if engine.dialect.name == "postgresql": expr = func.trunc(expr)
+    return cast(expr, Integer)
+
+def sql_offline_progress(current_time, is_active=False):
+    """SQL-версия offline_progress: (доход лодки, энергия) из текущих значений строки."""
+    c = users.c
+    time_diff = case((current_time - c.last_active_at < 0, 0), else_=current_time - c.last_active_at)
+    max_seconds = case({lvl: hours * 3600 for lvl, hours in BOAT_MAX_HOURS.items()}, value=c.boat_level, else_=0)
+    income = case({lvl: float(v) for lvl, v in BOAT_INCOME.items()}, value=c.boat_level, else_=0.0)
+    earned = sql_int(sql_least(time_diff, max_seconds) * income)
+    energy = sql_least(MAX_ENERGY, c.energy + time_diff * ENERGY_REGEN_PER_SEC)
+    if is_active:
+        energy = case((time_diff > ACTIVE_REGEN_DELAY, energy), else_=c.energy)
+    return earned, energy
+
+STATE_COLUMNS = (users.c.balance, users.c.energy, users.c.rod_level, users.c.boat_level,
+                 users.c.bait_common, users.c.bait_rare, users.c.last_bait, users.c.last_afk)
+
+async def run_atomic(stmt, params=None):
+    if sqlite_writer is not None:
+        return await sqlite_writer.execute(stmt, params)
+    async with atomic_engine.connect() as conn:
+        return (await conn.execute(stmt, params)).first()
+
+async def load_user(telegram_id):
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(User).where(User.telegram_id == telegram_id))
+        return result.scalars().first()
+
+def reward_param(bait, rod_level):
+    return f"reward_{BAIT_CODES[bait]}_{rod_level}"
+
+def build_click_statement():
+    """UPDATE клика собирается один раз: время, id и награды исхода по наживке и удочке
+    приходят параметрами, поэтому на клик нет сборки выражения и компиляции SQL."""
+    c = users.c
+    now = bindparam("now", type_=Float)
+    now_s = bindparam("now_s", type_=Integer)
+    earned, energy = sql_offline_progress(now_s, is_active=True)
+
+    def reward_by_rod(bait):
+        rewards = {lvl: bindparam(reward_param(bait, lvl), type_=Integer) for lvl in ROD_PRICES}
+        return case(rewards, value=c.rod_level, else_=0)
+
+    return update(users).where(
+        c.telegram_id == bindparam("tid", type_=BigInteger),
+        c.last_click_at <= bindparam("cooldown_until", type_=Float),   # --- ANTI-CLICKER ---
+        energy >= ENERGY_COST
+    ).values(
+        # Все выражения считаются от старых значений строки
+        balance=c.balance + earned + case(
+            (c.bait_rare > 0, reward_by_rod("rare")),
+            (c.bait_common > 0, reward_by_rod("common")),
+            else_=reward_by_rod(None)
+        ),
+        energy=energy - ENERGY_COST,
+        bait_rare=case((c.bait_rare > 0, c.bait_rare - 1), else_=c.bait_rare),
+        bait_common=case((c.bait_rare == 0, case((c.bait_common > 0, c.bait_common - 1), else_=c.bait_common)), else_=c.bait_common),
+        last_bait=case((c.bait_rare > 0, BAIT_CODES["rare"]), (c.bait_common > 0, BAIT_CODES["common"]), else_=BAIT_CODES[None]),
+        last_click_at=now,
+        last_active_at=now_s,
+        last_afk=earned
+    ).returning(*STATE_COLUMNS)
+
+CLICK_STATEMENT = build_click_statement()
+
+async def atomic_click(telegram_id, current_time, protocol=1):
+    u = random.random()
+    # Рыба и вес заранее для каждой таблицы улова (одинаковые таблицы общие)
+    rolls = {}
+    for sampler in FISH_SAMPLERS.values():
+        if id(sampler) not in rolls:
+            fish = sampler.sample()
+            rolls[id(sampler)] = (fish, roll_weight(fish))
+
+    # Исход для каждой наживки и уровня удочки: (рыба, вес, награда) или None при промахе
+    outcomes = {}
+    params = {
+        "tid": telegram_id, "now": current_time, "now_s": int(current_time),
+        "cooldown_until": current_time - CLICK_COOLDOWN
+    }
+    for bait in BAIT_CODES:
+        for rod_level in ROD_PRICES:
+            outcome = None
+            if u <= catch_chance(rod_level, bait):
+                fish, weight = rolls[id(get_fish_sampler(bait, rod_level))]
+                outcome = (fish, weight, catch_reward(fish, rod_level))
+            outcomes[(bait, rod_level)] = outcome
+            params[reward_param(bait, rod_level)] = outcome[2] if outcome else 0
+
+    row = await run_atomic(CLICK_STATEMENT, params)
+    if row is None:
+        # Клик отклонён: читаем состояние, чтобы понять причину (без записи)
+        user = await load_user(telegram_id)
+        if not user: return {"status": "error"}
+        state = projected_state(user, int(current_time), is_active=True)
+        status = "cooldown" if current_time - user.last_click_at < CLICK_COOLDOWN else "no_energy"
+        response = {"status": status, "balance": state["balance"], "energy": state["energy"]}
+        if protocol < 2: response["afk_earned"] = 0
+        return response
+
+    used_bait = next(b for b, code in BAIT_CODES.items() if code == row.last_bait)
+    outcome = outcomes.get((used_bait, row.rod_level))
+    if outcome is None:
+        return click_response("miss", row, row.last_afk, used_bait, protocol)
+
+    fish, weight, reward = outcome
+    await record_catch({
+        "user_id": telegram_id,
+        "fish": FISH_CODES[fish['id']],
+        "weight": weight,
+        "reward": reward
+    })
+    return catch_response(fish, weight, reward, row, row.last_afk, used_bait, protocol)
+
+async def atomic_purchase(telegram_id, item_id, current_time):
+    c = users.c
+    # Покупка - переход состояния: заодно фиксируем доход лодки и энергию
+    earned, energy = sql_offline_progress(current_time)
+    values = {"energy": energy, "last_active_at": current_time, "last_afk": earned}
+
+    if item_id == "rod":
+        next_prices = {lvl: ROD_PRICES[lvl + 1] for lvl in ROD_PRICES if lvl + 1 in ROD_PRICES}
+        price = case(next_prices, value=c.rod_level, else_=0)
+        condition = c.rod_level < max(ROD_PRICES)
+        values["rod_level"] = c.rod_level + 1
+    elif item_id == "boat":
+        next_prices = {lvl: BOAT_PRICES[lvl + 1] for lvl in range(max(BOAT_PRICES)) if lvl + 1 in BOAT_PRICES}
+        price = case(next_prices, value=c.boat_level, else_=0)
+        condition = c.boat_level < max(BOAT_PRICES)
+        values["boat_level"] = c.boat_level + 1
+    elif item_id in CONSUMABLES:
+        item = CONSUMABLES[item_id]
+        price = item['price']
+        condition = c.telegram_id == telegram_id
+        if item_id == "energy_drink":
+            values["energy"] = sql_least(MAX_ENERGY, energy + item['energy'])
+        else:
+            values[item_id] = c[item_id] + item['amount']
+    else:
+        price, condition = None, None
+
+    row = None
+    if price is not None:
+        values["balance"] = c.balance + earned - price
+        stmt = update(users).where(c.telegram_id == telegram_id, condition, c.balance + earned >= price) \
+                            .values(**values).returning(*STATE_COLUMNS)
+        row = await run_atomic(stmt)
+
+    if row is None:
+        # Не хватило денег / максимальный уровень: отдаём текущее состояние без записи
+        user = await load_user(telegram_id)
+        if not user: return {"success": False}
+        return {"success": False, **projected_state(user, current_time)}
+
+    state = player_state(row)
+    player_events.publish(telegram_id, state)
+    return {"success": True, **state}
+
+def build_settle_statement(current_time, ad_reward=False):
+    """Фиксация дохода лодки и энергии (с ad_reward - ещё награда за рекламу и полная энергия).
+    Баланс прибавляется к значению в строке, а не пишется абсолютным из прочитанного объекта."""
+    c = users.c
+    earned, energy = sql_offline_progress(current_time)
+    values = {"balance": c.balance + earned, "energy": energy, "last_active_at": current_time, "last_afk": earned}
+    if ad_reward:
+        rewards = {lvl: ad_reward_amount(lvl) for lvl in ROD_PRICES}
+        values["balance"] = c.balance + earned + case(rewards, value=c.rod_level, else_=0)
+        values["energy"] = MAX_ENERGY
+    return update(users).where(c.telegram_id == bindparam("tid", type_=BigInteger)) \
+                        .values(**values).returning(*STATE_COLUMNS)
+
+async def settle_player(telegram_id, current_time):
+    """Фиксирует доход лодки и энергию на current_time: (состояние, доход) или (None, 0), если игрока нет.
+    Вызывается вне open_player, чтобы не держать два соединения пула."""
+    if ATOMIC_UPDATES:
+        row = await run_atomic(build_settle_statement(current_time), {"tid": telegram_id})
+        if row is None: return None, 0
+        return player_state(row), row.last_afk
+    async with open_player(telegram_id) as user:
+        if not user: return None, 0
+        earned = calculate_offline_progress(user, current_time)
+        return player_state(user), earned
+
+# --- ЛИМИТЫ ЗАПРОСОВ (В ПАМЯТИ, ДО ОБРАЩЕНИЯ К БД) ---
+
+class RateLimiter:
+    """Token bucket на ключ (telegram_id или IP): rate токенов в секунду, не больше burst.
+    Записи разложены по шардам, и за один вызов чистится не больше одного шарда -
+    без пауз на обход всей таблицы. Ведро, простоявшее burst / rate секунд, снова полное,
+    то есть неотличимо от отсутствующего: такие записи удаляются, память ограничена
+    числом активных ключей."""
+    def __init__(self, rate, burst, shards=16, sweep_interval=10):
+        self.rate = rate
+        self.burst = burst
+        self.full_after = burst / rate
+        self.shards = [{} for _ in range(max(1, shards))]
+        self.sweep_step = sweep_interval / len(self.shards)
+        self._sweep_at = 0.0
+        self._next_shard = 0
+
+    def allow(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        shard = self.shards[hash(key) % len(self.shards)]
+        bucket = shard.get(key)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        allowed = tokens >= 1
+        shard[key] = (tokens - 1 if allowed else tokens, now)
+        if now >= self._sweep_at: self._sweep(now)
+        return allowed
+
+    def retry_after(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        bucket = self.shards[hash(key) % len(self.shards)].get(key)
+        if bucket is None: return 0.0
+        return max(0.0, (1 - bucket[0]) / self.rate - (now - bucket[1]))
+
+    def _sweep(self, now):
+        shard = self.shards[self._next_shard]
+        self._next_shard = (self._next_shard + 1) % len(self.shards)
+        self._sweep_at = now + self.sweep_step
+        stale = [key for key, (_, last) in shard.items() if now - last >= self.full_after]
+        for key in stale: del shard[key]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+# Тот же кулдаун, что проверяет БД: отказ здесь совпадает с тем, что ответил бы сервер после SELECT.
+# БД остаётся источником истины (другие воркеры, гонки), лимитер лишь отсекает заведомые отказы.
+click_limiter = RateLimiter(1 / CLICK_COOLDOWN, RATE_LIMIT_CLICK_BURST, RATE_LIMIT_SHARDS, RATE_LIMIT_SWEEP_INTERVAL) \
+    if RATE_LIMIT_ENABLED else None
+ip_limiter = RateLimiter(RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST, RATE_LIMIT_SHARDS, RATE_LIMIT_SWEEP_INTERVAL) \
+    if RATE_LIMIT_ENABLED and RATE_LIMIT_IP_ENABLED else None
+
+def client_ip(request):
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded: return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else ""
+
+async def limit_ip(request: Request):
+    """Грубый лимит по IP для /api/init, /api/stream и чтений (FastAPI dependency)."""
+    if ip_limiter is None: return
+    ip = client_ip(request)
+    if not ip_limiter.allow(ip):
+        RATE_LIMITED.inc("ip")
+        raise HTTPException(429, "Too many requests", headers={"Retry-After": str(int(ip_limiter.retry_after(ip)) + 1)})
+
+MetricGauge("fishing_rate_limiter_keys", "Keys tracked by the click limiter", fn=lambda: len(click_limiter) if click_limiter else None)
+
+# --- СТАТИКА ---
+# Собранные файлы лежат поверх static/: имя с хэшем содержимого кэшируется навсегда,
+# index.html и несобранные файлы - с перепроверкой по ETag. Форматы выбираются по заголовкам запроса.
+HASHED_ASSET = re.compile(r"\.[0-9a-f]{10}\.\w+$")
+IMAGE_VARIANTS = (("image/avif", ".avif"), ("image/webp", ".webp"))
+ENCODED_VARIANTS = (("br", ".br"), ("gzip", ".gz"))
+
+def accepts(header, value):
+    """value перечислен в Accept/Accept-Encoding и не запрещён через q=0."""
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        if name.strip().lower() != value: continue
+        for param in params.split(";"):
+            key, _, q = param.strip().partition("=")
+            if key == "q":
+                try: return float(q) > 0
+                except ValueError: return False
+        return True
+    return False
+
+class StaticAssets(StaticFiles):
+    def __init__(self, directory, build_dir):
+        super().__init__(directory=directory)
+        self.built = os.path.isdir(build_dir)
+        if self.built:
+            self.all_directories = [build_dir, *self.all_directories]
+
+    def lookup_path(self, path):
+        full_path, stat_result = super().lookup_path(path)
+        if self.built and path == "index.html" and stat_result is not None:
+            # index.html правили после build_static.py - отдаём исходник, а не устаревшую сборку
+            source = os.path.join(self.directory, "index.html")
+            if os.path.isfile(source) and os.path.getmtime(source) > stat_result.st_mtime:
+                return source, os.stat(source)
+        return full_path, stat_result
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        full_path = str(full_path)
+        headers = Headers(scope=scope)
+        variants = IMAGE_VARIANTS if full_path.lower().endswith((".png", ".jpg", ".jpeg")) else ENCODED_VARIANTS
+        header = headers.get("accept" if variants is IMAGE_VARIANTS else "accept-encoding", "")
+        available = [(value, ext) for value, ext in variants if os.path.isfile(full_path + ext)]
+        chosen = next(((value, ext) for value, ext in available if accepts(header, value)), None)
+
+        if chosen is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+        else:
+            response = super().file_response(full_path + chosen[1], os.stat(full_path + chosen[1]), scope, status_code)
+            if variants is ENCODED_VARIANTS: response.headers["content-encoding"] = chosen[0]
+        if available:
+            response.headers["vary"] = "Accept" if variants is IMAGE_VARIANTS else "Accept-Encoding"
+        immutable = HASHED_ASSET.search(os.path.basename(full_path))
+        response.headers["cache-control"] = f"public, max-age={STATIC_MAX_AGE}, immutable" if immutable else "no-cache"
+        return response
+
+def load_asset_files():
+    """Карта "images/carp.png" -> "assets/carp.<hash>.png" из последней сборки."""
+    try:
+        with open(os.path.join(STATIC_BUILD_DIR, "manifest.json")) as f:
+            return json.load(f).get("files", {})
+    except FileNotFoundError:
+        return {}
+
+ASSET_FILES = load_asset_files()
+
+def asset_url(path):
+    return f"/static/{ASSET_FILES.get(path, path)}"
 
 logging.basicConfig(level=logging.INFO)
 app = FastAPI()
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_SERVER)) if BOT_API_SERVER else None)
 dp = Dispatcher()
-app.mount("/static", StaticFiles(directory="static"), name="static")
+static_files = StaticAssets("static", STATIC_BUILD_DIR)
+built_index = os.path.join(STATIC_BUILD_DIR, "index.html")
+if os.path.isfile(built_index) and os.path.getmtime("static/index.html") > os.path.getmtime(built_index):
+    logging.warning(f"static/index.html is newer than {STATIC_BUILD_DIR}, serving the source until build_static.py is re-run")
+app.mount("/static", static_files, name="static")
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+    @dp.update.outer_middleware()
+    async def bot_metrics(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                update_type = event.event_type
+            except Exception:
+                update_type = "unknown"
+            BOT_LATENCY.observe(time.perf_counter() - started, update_type)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def init_response(state, earned, protocol=1):
+    if protocol >= 2:
+        # adsgram_id клиент тоже знает из /api/catalog
+        response = compact_state(state, protocol)
+        if earned: response["offline_earned"] = earned
+        return response
+    return {
+        **state,
+        "offline_earned": earned, 
+        "adsgram_id": ADSGRAM_ID
+    }
 
-@app.post("/api/init")
+@app.post("/api/init", dependencies=[Depends(limit_ip)])
 async def init_user(data: InitRequest):
     current_time = int(time.time())
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).where(User.telegram_id == data.telegram_id))
-        user = result.scalars().first()
-        earned = 0
-        
-        if not user:
-            # SOFT LAUNCH: Даем ресурсы новичку
-            user = User(
-                telegram_id=data.telegram_id, 
-                username=data.username,
-                first_name=data.first_name, 
-                last_name=data.last_name,   
-                last_active_at=current_time,
-                balance=200,    # Стартовый бонус
-                bait_common=5   # 5 бесплатных червей
-            )
-            session.add(user)
-        else:
-            if data.username: user.username = data.username
-            if data.first_name: user.first_name = data.first_name
-            if data.last_name: user.last_name = data.last_name
-            earned = calculate_offline_progress(user, current_time)
-        
-        await session.commit()
-        
-        return {
-            "balance": user.balance, 
-            "energy": int(user.energy),
-            "rod_level": user.rod_level, 
-            "boat_level": user.boat_level,
-            "rod_price": ROD_PRICES.get(user.rod_level + 1), 
-            "boat_price": BOAT_PRICES.get(user.boat_level + 1),
-            "bait_common": user.bait_common,
-            "bait_rare": user.bait_rare,
-            "offline_earned": earned, 
-            "adsgram_id": ADSGRAM_ID
-        }
+    async with open_player(data.telegram_id) as user:
+        if user:
+            # Профиль пишем, только если он действительно изменился
+            for field in ("username", "first_name", "last_name"):
+                value = getattr(data, field)
+                if value and getattr(user, field) != value: setattr(user, field, value)
+            state, earned = observe_player(user, current_time)
+            # Открытие игры фиксирует доход лодки: offline_earned показывается один раз.
+            # Синхронизация только читает, пока не заполнился трюм (иначе лодка встанет)
+            if not hold_is_full(user, current_time) and (data.sync or not earned):
+                return GameJSONResponse(init_response(state, earned, data.v))
+
+    if user:
+        state, earned = await settle_player(data.telegram_id, current_time)
+        return GameJSONResponse(init_response(state, earned, data.v))
+    
+    # SOFT LAUNCH: Даем ресурсы новичку.
+    # Создаём вне open_player: иначе запрос держит два соединения пула сразу, и пачка новичков его исчерпывает
+    user = await create_player(User(
+        telegram_id=data.telegram_id, 
+        username=data.username,
+        first_name=data.first_name, 
+        last_name=data.last_name,   
+        last_active_at=current_time,
+        balance=START_BALANCE,
+        bait_common=START_BAIT_COMMON
+    ))
+    return GameJSONResponse(init_response(player_state(user), 0, data.v))
+
+async def sync_player(telegram_id):
+    """Текущее состояние для push-канала (без записи). None, если игрока нет."""
+    current_time = int(time.time())
+    async with open_player(telegram_id) as user:
+        if not user: return None
+        state, _ = observe_player(user, current_time)
+        if not hold_is_full(user, current_time): return state
+    state, _ = await settle_player(telegram_id, current_time)
+    return state
+
+@app.get("/api/stream", dependencies=[Depends(limit_ip)])
+async def stream_state(request: Request, telegram_id: int, v: int = 1):
+    """SSE: шлёт состояние только при изменении, иначе лёгкий ping раз в STREAM_HEARTBEAT."""
+    # Неизвестному игроку поток не открываем: иначе он держит подписку и ходит в БД каждый heartbeat
+    first = await sync_player(telegram_id)
+    if first is None: raise HTTPException(404, "Player not found")
+    queue = player_events.subscribe(telegram_id)
+
+    async def events():
+        last = None
+        try:
+            payload = first
+            while payload is not None:
+                if payload != last:
+                    last = payload
+                    yield f"data: {game_json(compact_state(payload, v)).decode()}\n\n"
+                else:
+                    yield "event: ping\ndata: {}\n\n"
+
+                if await request.is_disconnected(): break
+                try:
+                    payload = await asyncio.wait_for(queue.get(), STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    payload = await sync_player(telegram_id)
+        finally:
+            player_events.unsubscribe(telegram_id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # nginx не должен буферизовать поток
+    })
 
 @app.post("/api/fish")
 async def fish_action(data: ClickRequest):
+    if click_limiter is not None and not click_limiter.allow(data.telegram_id):
+        # Кулдаун без обращения к БД (клиент на cooldown смотрит только на статус)
+        RATE_LIMITED.inc("click")
+        response = {"status": "cooldown"}
+    else:
+        response = await play_click(data)
+    CLICKS.inc(response["status"])
+    if response["status"] == "caught": CATCHES.inc(FISH_BY_ID[response["fish_id"]]["rarity"])
+    return GameJSONResponse(response)
+
+async def play_click(data):
     current_time = time.time()
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).where(User.telegram_id == data.telegram_id))
-        user = result.scalars().first()
-        
+    if ATOMIC_UPDATES:
+        return await atomic_click(data.telegram_id, current_time, data.v)
+
+    async with open_player(data.telegram_id) as user:
         # Считаем пассивный доход перед действием
         afk_earned = calculate_offline_progress(user, int(current_time), is_active=True)
         
         # --- ANTI-CLICKER ---
         if current_time - user.last_click_at < CLICK_COOLDOWN:
-             return {"status": "cooldown", "balance": user.balance, "energy": int(user.energy), "afk_earned": afk_earned}
+             return click_response("cooldown", user, afk_earned, protocol=data.v)
         user.last_click_at = current_time
 
-        # Фиксированная цена клика (убрали наказание за усталость)
-        energy_cost = 2.0 
-        
-        if user.energy < energy_cost:
-            await session.commit()
-            return {"status": "no_energy", "balance": user.balance, "energy": int(user.energy), "afk_earned": afk_earned}
+        status, fish, reward, used_bait = apply_click(user)
+        if status != "caught":
+            return click_response(status, user, afk_earned, used_bait, data.v)
+        weight = roll_weight(fish)
 
-        # --- ЛОГИКА НАЖИВКИ ---
-        used_bait = None
-        luck_boost = 0.0
-        
-        if user.bait_rare > 0:
-            user.bait_rare -= 1
-            used_bait = "rare"
-            luck_boost = 0.35 # +35% шанса
-        elif user.bait_common > 0:
-            user.bait_common -= 1
-            used_bait = "common"
-            luck_boost = 0.15 # +15% шанса
-
-        # --- БАЛАНС: ШАНСЫ ---
-        # База 30% + бонус за уровень удочки (макс 95%)
-        catch_chance = 0.30 + (user.rod_level * 0.04) + luck_boost
-        catch_chance = min(catch_chance, 0.95)
-        
-        user.energy = max(0.0, user.energy - energy_cost)
-        
-        # Промах
-        if random.random() > catch_chance:
-            await session.commit()
-            return {
-                "status": "miss", 
-                "balance": user.balance, 
-                "energy": int(user.energy), 
-                "afk_earned": afk_earned,
-                "bait_common": user.bait_common,
-                "bait_rare": user.bait_rare
-            }
-
-        # ВЫБОР РЫБЫ
-        weights = [f['weight'] for f in FISH_TABLE]
-        
-        # Если редкая наживка: убираем мусор, НО оставляем Сундук (Chest)
-        if used_bait == "rare":
-            weights = [w if (not f['is_trash'] or f['id'] == 'chest') else 0 for f, w in zip(FISH_TABLE, weights)]
-        
-        try:
-            fish = random.choices(FISH_TABLE, weights=weights, k=1)[0]
-        except ValueError:
-             fish = FISH_TABLE[0]
+    await record_catch({
+        "user_id": user.telegram_id,
+        "fish": FISH_CODES[fish['id']],
+        "weight": weight,
+        "reward": reward
+    })
+    return catch_response(fish, weight, reward, user, afk_earned, used_bait, data.v)
 
-        weight = 0.0
-        if not fish['is_trash']:
-            weight = round(random.uniform(fish['min_w'], fish['max_w']), 2)
-        
-        # --- БАЛАНС: НАГРАДА ---
-        # Нелинейный рост силы удочки (x^1.15), чтобы поспевать за ценами
-        rod_multiplier = user.rod_level ** 1.15
-        base_power = 15 * rod_multiplier
-        
-        reward = 0
-        if fish['is_trash'] and fish['id'] != 'chest':
-            # "Эко-сбор": символическая плата за мусор
-            reward = int(5 * rod_multiplier)
-        else:
-            reward = int(base_power * fish['mult'])
+@app.post("/api/upgrade")
+async def buy_upgrade(data: BuyRequest):
+    current_time = int(time.time())
+    if ATOMIC_UPDATES:
+        return GameJSONResponse(compact_state(await atomic_purchase(data.telegram_id, data.item_id, current_time), data.v))
 
-        user.balance += reward
-        
-        new_catch = Catch(
-            user_id=user.telegram_id,
-            fish_id=fish['id'],
-            weight=weight,
-            is_trash=fish['is_trash'],
-            reward=reward
-        )
-        session.add(new_catch)
+    async with open_player(data.telegram_id) as user:
+        # Покупка - переход состояния: фиксируем накопленный доход лодки и энергию
+        calculate_offline_progress(user, current_time)
+        success = apply_purchase(user, data.item_id)
 
-        await session.commit()
-        return {
-            "status": "caught", 
-            "fish_id": fish['id'], "fish_emoji": fish['emoji'], "fish_color": fish['color'],
-            "reward": reward, "weight": weight, "is_trash": fish['is_trash'],
-            "rarity": fish.get('rarity', 1), # Добавили редкость для шаринга
-            "balance": user.balance, "energy": int(user.energy), 
-            "afk_earned": afk_earned,
-            "bait_common": user.bait_common,
-            "bait_rare": user.bait_rare
-        }
+    # Снасти стоят дорого: покупку удочки/лодки пишем в БД сразу, не дожидаясь пакета
+    if success and player_cache is not None and data.item_id in ("rod", "boat"):
+        await player_cache.flush([user.telegram_id])
 
-@app.post("/api/upgrade")
-async def buy_upgrade(data: BuyRequest):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).where(User.telegram_id == data.telegram_id))
-        user = result.scalars().first()
-        success = False
-        
-        # --- ОБРАБОТКА ПОКУПОК ---
-        if data.item_id == "rod":
-            price = ROD_PRICES.get(user.rod_level + 1)
-            if price and user.balance >= price:
-                user.balance -= price; user.rod_level += 1; success = True
-                
-        elif data.item_id == "boat":
-            price = BOAT_PRICES.get(user.boat_level + 1)
-            if price and user.balance >= price:
-                user.balance -= price; user.boat_level += 1; success = True
-        
-        elif data.item_id in CONSUMABLES:
-            item = CONSUMABLES[data.item_id]
-            if user.balance >= item['price']:
-                user.balance -= item['price']
-                success = True
-                
-                if data.item_id == "energy_drink":
-                    user.energy = min(MAX_ENERGY, user.energy + item['energy'])
-                elif data.item_id == "bait_common":
-                    user.bait_common += item['amount']
-                elif data.item_id == "bait_rare":
-                    user.bait_rare += item['amount']
-
-        await session.commit()
-        
-        return {
-            "success": success, 
-            "balance": user.balance, 
-            "energy": int(user.energy),
-            "rod_level": user.rod_level, 
-            "boat_level": user.boat_level, 
-            "rod_price": ROD_PRICES.get(user.rod_level + 1), 
-            "boat_price": BOAT_PRICES.get(user.boat_level + 1),
-            "bait_common": user.bait_common,
-            "bait_rare": user.bait_rare
-        }
+    state = player_state(user)
+    if success: player_events.publish(user.telegram_id, state)
+    return GameJSONResponse(compact_state({"success": success, **state}, data.v))
 
 @app.post("/api/ad_reward")
 async def ad_reward(data: AdRewardRequest):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).where(User.telegram_id == data.telegram_id))
-        user = result.scalars().first()
+    current_time = int(time.time())
+    if ATOMIC_UPDATES:
+        row = await run_atomic(build_settle_statement(current_time, ad_reward=True), {"tid": data.telegram_id})
+        if row is None: return {"success": False}
+        player_events.publish(data.telegram_id, player_state(row))
+        return {"success": True, "balance": row.balance, "energy": int(row.energy), "reward": ad_reward_amount(row.rod_level)}
+
+    async with open_player(data.telegram_id) as user:
         if not user: return {"success": False}
+        calculate_offline_progress(user, current_time)
         
-        # ДИНАМИЧЕСКАЯ НАГРАДА
-        # 500 база + (уровень * 250). На 10 уровне ~3000 монет.
-        base_reward = 500
-        scaling = user.rod_level * 250
-        total_reward = base_reward + scaling
+        # ДИНАМИЧЕСКАЯ НАГРАДА (см. ad_reward_amount)
+        total_reward = ad_reward_amount(user.rod_level)
         
         user.balance += total_reward
         user.energy = 100
-        await session.commit()
+        player_events.publish(user.telegram_id, player_state(user))
         return {"success": True, "balance": user.balance, "energy": int(user.energy), "reward": total_reward}
 
-@app.get("/api/leaderboard")
-async def get_leaderboard(type: str = "balance", period: str = "all"):
+LEADERBOARD_TYPES = ("balance", "weight", "trash")
+LEADERBOARD_PERIODS = {"week": 7, "month": 30, "year": 365, "all": None}
+
+def period_start(period, today):
+    """Первый день периода: N дневных корзин, считая сегодняшнюю (неделя - 7 дней, а не 8). None для "all"."""
+    days = LEADERBOARD_PERIODS[period]
+    return today - timedelta(days=days - 1) if days else None
+
+def display_name(row):
+    d_name = row.username
+    if row.first_name:
+        d_name = row.first_name
+        if row.last_name:
+            d_name += f" {row.last_name}"
+    return d_name or "Fisher"
+
+async def query_leaderboard(type, period):
     async with AsyncSessionLocal() as session:
-        date_filter = None
-        now = datetime.utcnow()
-        if period == "week": date_filter = now - timedelta(days=7)
-        elif period == "month": date_filter = now - timedelta(days=30)
-        elif period == "year": date_filter = now - timedelta(days=365)
-        
-        stmt = None
+        date_filter = period_start(period, datetime.utcnow().date())
+        score_col = "reward" if type == "balance" else type
         
-        if type == "balance":
-            stmt = select(User.first_name, User.last_name, User.username, func.sum(Catch.reward).label("score")) \
-                   .join(Catch, User.telegram_id == Catch.user_id) \
-                   .group_by(User.telegram_id, User.first_name, User.last_name, User.username).order_by(desc("score"))
-        elif type == "weight":
-            stmt = select(User.first_name, User.last_name, User.username, func.sum(Catch.weight).label("score")) \
-                   .join(Catch, User.telegram_id == Catch.user_id) \
-                   .where(Catch.is_trash == False).group_by(User.telegram_id, User.first_name, User.last_name, User.username).order_by(desc("score"))
-        elif type == "trash":
-            stmt = select(User.first_name, User.last_name, User.username, func.count(Catch.id).label("score")) \
-                   .join(Catch, User.telegram_id == Catch.user_id) \
-                   .where(Catch.is_trash == True).group_by(User.telegram_id, User.first_name, User.last_name, User.username).order_by(desc("score"))
+        # "all" читаем из готовых итогов, остальные периоды - суммой дневных корзин
+        if date_filter:
+            scores = select(ScoreDaily.user_id, func.sum(getattr(ScoreDaily, score_col)).label("score")) \
+                     .where(ScoreDaily.day >= date_filter).group_by(ScoreDaily.user_id).subquery()
+        else:
+            scores = select(ScoreTotal.user_id, getattr(ScoreTotal, score_col).label("score")).subquery()
         
-        if date_filter: stmt = stmt.where(Catch.caught_at >= date_filter)
-        stmt = stmt.limit(10)
+        # В роллапах есть строки с нулём (только мусор - вес 0, без мусора - trash 0); раньше JOIN с
+        # отфильтрованными catches таких игроков в топ не пускал, score > 0 сохраняет это поведение
+        stmt = select(User.first_name, User.last_name, User.username, scores.c.score) \
+               .join(scores, User.telegram_id == scores.c.user_id) \
+               .where(scores.c.score > 0).order_by(desc(scores.c.score)).limit(10)
         
-        total_stmt = select(func.count(User.telegram_id))
+        total_stmt = select(Counter.value).where(Counter.name == "players")
         
-        try:
-            result = await session.execute(stmt)
-            data = result.all()
-            total_result = await session.execute(total_stmt)
-            total_count = total_result.scalar() or 0
-        except Exception as e:
-            logging.error(f"Error LB: {e}")
-            return {"leaderboard": [], "total": 0}
-
-        leaderboard_data = []
-        for row in data:
-            d_name = row.username
-            if row.first_name:
-                d_name = row.first_name
-                if row.last_name:
-                    d_name += f" {row.last_name}"
-            if not d_name: d_name = "Fisher"
-            leaderboard_data.append({"username": d_name, "value": row.score or 0})
+        result = await session.execute(stmt)
+        data = result.all()
+        total_result = await session.execute(total_stmt)
+        total_count = total_result.scalar() or 0
+
+        leaderboard_data = [{"username": display_name(row), "value": row.score or 0} for row in data]
         
         return {
             "leaderboard": leaderboard_data,
             "total": total_count
         }
 
+class Snapshot:
+    __slots__ = ("body", "etag", "created")
+
+    def __init__(self, payload):
+        self.body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest()[:20] + '"'
+        self.created = time.monotonic()
+
+class SnapshotCache:
+    """Готовые ответы по ключу: свежий снимок отдаётся из памяти, устаревший (в пределах stale) -
+    тоже, но с фоновым обновлением. Одновременные промахи ждут один запрос к БД (single-flight)."""
+    def __init__(self, loader, ttl, stale):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale = stale
+        self.entries = {}
+        self._refreshing = {}  # ключ -> Task текущего обновления
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        age = time.monotonic() - entry.created if entry else None
+        if entry and age < self.ttl:
+            LEADERBOARD_CACHE.inc("fresh")
+            return entry
+        if entry and age < self.ttl + self.stale:
+            LEADERBOARD_CACHE.inc("stale")
+            self._refresh(key)
+            return entry
+        LEADERBOARD_CACHE.inc("coalesced" if key in self._refreshing else "miss")
+        # shield: отключившийся клиент не отменяет общий для всех запрос
+        return await asyncio.shield(self._refresh(key))
+
+    def _refresh(self, key):
+        task = self._refreshing.get(key)
+        if task is None:
+            task = self._refreshing[key] = asyncio.create_task(self._load(key))
+            task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+        return task
+
+    async def _load(self, key):
+        try:
+            entry = Snapshot(await self.loader(*key))
+        except Exception as e:
+            logging.error(f"Error LB: {e}")
+            # БД недоступна: лучше старый снимок, чем пустой топ
+            entry = self.entries.get(key)
+            if entry is None: raise
+            return entry
+        self.entries[key] = entry
+        return entry
+
+leaderboard_cache = SnapshotCache(query_leaderboard, LEADERBOARD_TTL, LEADERBOARD_STALE)
+
+@app.get("/api/leaderboard", dependencies=[Depends(limit_ip)])
+async def get_leaderboard(request: Request, type: str = "balance", period: str = "all"):
+    if type not in LEADERBOARD_TYPES:
+        return {"leaderboard": [], "total": 0}
+    if period not in LEADERBOARD_PERIODS: period = "all"
+
+    try:
+        snapshot = await leaderboard_cache.get((type, period))
+    except Exception:
+        return {"leaderboard": [], "total": 0}
+
+    headers = {
+        "ETag": snapshot.etag,
+        # Одинаков для всех игроков: браузер и прокси могут кэшировать и переспрашивать по ETag
+        "Cache-Control": f"public, max-age={LEADERBOARD_TTL}, stale-while-revalidate={LEADERBOARD_STALE}"
+    }
+    if request.headers.get("If-None-Match") == snapshot.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(snapshot.body, media_type="application/json", headers=headers)
+
+# --- КАТАЛОГ (ПРОТОКОЛ 2) ---
+def build_catalog():
+    """Статичные данные игры для клиента протокола 2: меняются только с деплоем."""
+    return {
+        "protocol": PROTOCOL_VERSION,
+        "fish": {
+            fish['id']: {"emoji": fish['emoji'], "color": fish['color'], "rarity": fish['rarity'],
+                         "is_trash": fish['is_trash'], "image": asset_url(f"images/{fish['id']}.png")}
+            for fish in FISH_TABLE
+        },
+        "rod_prices": ROD_PRICES,
+        "boat_prices": BOAT_PRICES,
+        "consumables": CONSUMABLES,
+        "adsgram_id": ADSGRAM_ID,
+    }
+
+CATALOG = Snapshot(build_catalog())
+
+@app.get("/api/catalog")
+async def get_catalog(request: Request):
+    headers = {"ETag": CATALOG.etag, "Cache-Control": "public, max-age=3600"}
+    if request.headers.get("If-None-Match") == CATALOG.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(CATALOG.body, media_type="application/json", headers=headers)
+
+# --- МЕСТО ИГРОКА В ЛИДЕРБОРДЕ ---
+
+class RankedScores:
+    """Очки игроков по убыванию: ключи (-очки, id) лежат в отсортированных корзинах до 2*BUCKET штук.
+    Корзина ключа ищется bisect по максимумам корзин, число ключей перед ней - деревом Фенвика
+    по размерам корзин. Ранг, выборка по месту и обновление - O(log n) плюс сдвиг внутри одной корзины."""
+    BUCKET = 512
+
+    def __init__(self, scores=()):
+        keys = sorted((-score, user_id) for user_id, score in scores if score and score > 0)
+        self.scores = {user_id: -neg for neg, user_id in keys}
+        self.buckets = [keys[i:i + self.BUCKET] for i in range(0, len(keys), self.BUCKET)] or [[]]
+        self._reindex()
+
+    def __len__(self):
+        return len(self.scores)
+
+    def _reindex(self):
+        self.maxes = [bucket[-1] for bucket in self.buckets if bucket]
+        n = len(self.buckets)
+        self.tree = [0] * (n + 1)
+        for i, bucket in enumerate(self.buckets, 1):
+            self.tree[i] += len(bucket)
+            parent = i + (i & -i)
+            if parent <= n: self.tree[parent] += self.tree[i]
+
+    def _tree_add(self, i, delta):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _before(self, i):
+        """Сколько ключей в корзинах до i-й."""
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, key):
+        return min(bisect_left(self.maxes, key), len(self.buckets) - 1)
+
+    def _insert(self, key):
+        i = self._locate(key)
+        bucket = self.buckets[i]
+        insort(bucket, key)
+        self._tree_add(i, 1)
+        if len(bucket) > 2 * self.BUCKET:
+            self.buckets[i:i + 1] = [bucket[:self.BUCKET], bucket[self.BUCKET:]]
+            self._reindex()
+        elif i < len(self.maxes):
+            self.maxes[i] = bucket[-1]
+        else:
+            self.maxes.append(bucket[-1])
+
+    def _remove(self, key):
+        i = self._locate(key)
+        bucket = self.buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        self._tree_add(i, -1)
+        if not bucket and len(self.buckets) > 1:
+            del self.buckets[i]
+            self._reindex()
+        elif bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            self.maxes = []
+
+    def set(self, user_id, score):
+        old = self.scores.pop(user_id, None)
+        if old is not None: self._remove((-old, user_id))
+        if score > 0:
+            self.scores[user_id] = score
+            self._insert((-score, user_id))
+
+    def add(self, user_id, delta):
+        if delta: self.set(user_id, self.scores.get(user_id, 0) + delta)
+
+    def rank(self, user_id):
+        """Место с 1 или None, если очков нет."""
+        score = self.scores.get(user_id)
+        if score is None: return None
+        key = (-score, user_id)
+        i = self._locate(key)
+        return self._before(i) + bisect_left(self.buckets[i], key) + 1
+
+    def at(self, position):
+        """(id, очки) на месте position (с 1): спуск по дереву Фенвика к нужной корзине."""
+        remaining, i = position - 1, 0
+        step = 1 << (len(self.buckets).bit_length() - 1)
+        while step:
+            if i + step < len(self.tree) and self.tree[i + step] <= remaining:
+                i += step
+                remaining -= self.tree[i]
+            step >>= 1
+        neg, user_id = self.buckets[i][remaining]
+        return user_id, -neg
+
+RANK_SEQ_COUNTER = "catch_batches"
+
+class RankBoard:
+    """RankedScores на каждую пару (type, period). Индекс строится из score_daily/score_totals при первом
+    запросе, затем пополняется дельтами записанных уловов; раз в RANK_REBUILD_INTERVAL и при смене дня
+    (окна week/month/year сдвигаются) перестраивается заново.
+    Снимок помечен номером последней вошедшей в него пачки уловов (счётчик catch_batches): пачки с
+    номером не больше него уже учтены, а пачки, записанные во время перестройки, доигрываются в новый индекс."""
+    COLUMNS = {"balance": "reward", "weight": "weight", "trash": "trash"}
+
+    def __init__(self, rebuild_interval):
+        self.rebuild_interval = rebuild_interval
+        self.indexes = {}   # (type, period) -> (RankedScores, день построения, время построения, номер пачки снимка)
+        self._pending = {}  # (type, period) -> [(номер пачки, строки)], пока индекс перестраивается
+        self._locks = {}
+
+    async def get(self, type, period):
+        key = (type, period)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:  # single-flight: индекс строит один запрос, остальные ждут его
+            entry = self.indexes.get(key)
+            today = datetime.utcnow().date()
+            if entry is None or entry[1] != today or time.monotonic() - entry[2] > self.rebuild_interval:
+                pending = self._pending[key] = []
+                try:
+                    index, seq = await self._build(type, period, today)
+                finally:
+                    del self._pending[key]
+                for batch_seq, daily_rows in pending:
+                    if batch_seq > seq: self._apply(index, type, period, today, daily_rows)
+                entry = self.indexes[key] = (index, today, time.monotonic(), seq)
+        return entry[0]
+
+    async def _build(self, type, period, today):
+        """Индекс и номер последней пачки в нём - одним запросом, то есть из одного снимка БД."""
+        score_col = self.COLUMNS[type]
+        start = period_start(period, today)
+        seq = select(Counter.value).where(Counter.name == RANK_SEQ_COUNTER).scalar_subquery()
+        if start:
+            stmt = select(ScoreDaily.user_id, func.sum(getattr(ScoreDaily, score_col)), seq) \
+                   .where(ScoreDaily.day >= start).group_by(ScoreDaily.user_id)
+        else:
+            stmt = select(ScoreTotal.user_id, getattr(ScoreTotal, score_col), seq)
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(stmt)).all()
+        # Пустой снимок: ни одна пачка из окна ещё не записана, доигрывать нужно все
+        return RankedScores((user_id, score) for user_id, score, _ in rows), (rows[0][2] or 0) if rows else 0
+
+    def _apply(self, index, type, period, built_day, daily_rows):
+        start = period_start(period, built_day)
+        score_col = self.COLUMNS[type]
+        for row in daily_rows:
+            if start and row["day"] < start: continue
+            index.add(row["user_id"], row[score_col])
+
+    def record(self, seq, daily_rows):
+        """Дельты из write_catches (строки score_daily) - во все построенные индексы, чьё окно их покрывает."""
+        for pending in self._pending.values():
+            pending.append((seq, daily_rows))
+        for (type, period), (index, built_day, _, built_seq) in self.indexes.items():
+            if seq > built_seq: self._apply(index, type, period, built_day, daily_rows)
+
+rank_board = RankBoard(RANK_REBUILD_INTERVAL) if RANK_ENABLED else None
+
+@app.get("/api/rank", dependencies=[Depends(limit_ip)])
+async def get_rank(telegram_id: int, type: str = "balance", period: str = "all", radius: int = 2):
+    """Место игрока, его очки и соседи сверху/снизу (radius мест в каждую сторону)."""
+    if rank_board is None or type not in LEADERBOARD_TYPES:
+        return {"rank": None, "value": 0, "total": 0, "around": []}
+    if period not in LEADERBOARD_PERIODS: period = "all"
+    radius = max(0, min(radius, 10))
+
+    index = await rank_board.get(type, period)
+    rank = index.rank(telegram_id)
+    if rank is None:
+        return {"rank": None, "value": 0, "total": len(index), "around": []}
+
+    first, last = max(1, rank - radius), min(len(index), rank + radius)
+    around = [(position, *index.at(position)) for position in range(first, last + 1)]
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(User.telegram_id, User.first_name, User.last_name, User.username)
+            .where(User.telegram_id.in_([user_id for _, user_id, _ in around]))
+        )
+        names = {row.telegram_id: display_name(row) for row in result}
+
+    return {
+        "rank": rank,
+        "value": index.scores[telegram_id],
+        "total": len(index),
+        "around": [
+            {"rank": position, "username": names.get(user_id, "Fisher"), "value": score, "me": user_id == telegram_id}
+            for position, user_id, score in around
+        ]
+    }
+
+# --- КОЛЛЕКЦИЯ ИГРОКА ---
+# Код рыбы -> fish_id; у старых записей с UNKNOWN_FISH_CODE вида нет (None)
+FISH_ID_BY_CODE = {code: fish_id for fish_id, code in FISH_CODES.items()}
+
+def unix_time(moment):
+    # В БД время UTC без зоны
+    return int(moment.replace(tzinfo=timezone.utc).timestamp())
+
+@app.get("/api/collection", dependencies=[Depends(limit_ip)])
+async def get_collection(telegram_id: int):
+    """Пойманные виды из счётчиков fish_stats: одна строка на вид, без обхода истории уловов."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(FishStats).where(FishStats.user_id == telegram_id))
+        stats = {row.fish: row for row in result.scalars()}
+
+    species = [
+        {
+            "fish_id": fish['id'], "count": row.count, "total_weight": round(row.weight, 2),
+            "max_weight": row.max_weight, "first_caught": unix_time(row.first_caught_at)
+        }
+        for fish in FISH_TABLE if (row := stats.get(FISH_CODES[fish['id']]))
+    ]
+    return {"species": species, "caught": len(species), "total": len(FISH_TABLE)}
+
+@app.get("/api/catches", dependencies=[Depends(limit_ip)])
+async def get_catches(telegram_id: int, cursor: str = None, limit: int = 20):
+    """Последние сырые уловы, от новых к старым. Страницы по ключу (caught_at, id) из индекса
+    ix_catches_user_caught: cursor - значение "next" прошлой страницы, без OFFSET."""
+    limit = max(1, min(limit, 100))
+    stmt = select(Catch.id, Catch.fish, Catch.weight, Catch.reward, Catch.caught_at) \
+           .where(Catch.user_id == telegram_id) \
+           .order_by(Catch.caught_at.desc(), Catch.id.desc()).limit(limit + 1)
+    if cursor:
+        try:
+            at, _, catch_id = cursor.rpartition("_")
+            stmt = stmt.where(tuple_(Catch.caught_at, Catch.id) < tuple_(
+                literal(datetime.fromisoformat(at), DateTime), literal(int(catch_id), BigInteger)))
+        except ValueError:
+            return {"catches": [], "next": None}
+
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(stmt)).all()
+    page = rows[:limit]
+    return {
+        "catches": [
+            {"fish_id": FISH_ID_BY_CODE.get(row.fish), "weight": row.weight, "reward": row.reward, "caught_at": unix_time(row.caught_at)}
+            for row in page
+        ],
+        # Сырые уловы старше retention.keep_days свёрнуты: лента заканчивается на окне хранения
+        "next": f"{page[-1].caught_at.isoformat()}_{page[-1].id}" if len(rows) > limit else None
+    }
+
 @dp.message()
 async def start_command(message: types.Message):
     markup = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="🎣 Play", web_app=WebAppInfo(url=f"{WEBAPP_URL}/static/index.html"))]])
     await message.answer("Let's go fishing!", reply_markup=markup)
 
-# --- ИСПРАВЛЕННЫЙ INLINE HANDLER (Поддержка PNG и Article) ---
+# --- ШАРИНГ УЛОВА (INLINE MODE) ---
+class LogThrottle:
+    """Строка лога не чаще раза в interval; пропущенные считаются и упоминаются в следующей."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = None
+        self.suppressed = 0
+
+    def __call__(self, level, message):
+        now = time.monotonic()
+        if self.last is not None and now - self.last < self.interval:
+            self.suppressed += 1
+            return
+        if self.suppressed: message += f" (+{self.suppressed} more in {int(now - self.last)} s)"
+        logging.log(level, message)
+        self.last, self.suppressed = now, 0
+
+share_log = LogThrottle(SHARE_LOG_INTERVAL)
+share_errors = LogThrottle(SHARE_LOG_INTERVAL)
+
+def parse_share_query(text):
+    """("carp", 1.25) из запроса "fish_id|weight|rarity"; None, если такого улова быть не может."""
+    parts = text.strip().split("|")
+    if len(parts) < 2: return None
+    fish = FISH_BY_ID.get(parts[0])
+    if fish is None: return None
+    try:
+        weight = round(float(parts[1]), 2)
+    except (ValueError, OverflowError):
+        return None
+    # Вес вне диапазона рыбы (и nan) - подделанный запрос
+    if not fish['min_w'] <= weight <= fish['max_w']: return None
+    return fish['id'], weight
+
+def build_share_result(fish_id, weight):
+    # Ссылка на картинку. Удаляем trailing slash у WEBAPP_URL, если есть.
+    base_url = WEBAPP_URL.rstrip('/')
+    thumb_url = f"{base_url}{asset_url(f'images/{fish_id}.png')}"
+    weight_text = f"{weight:.2f}".rstrip("0").rstrip(".")
+
+    # ХАК: Используем невидимую ссылку (zero-width char) для превью картинки.
+    # Это позволяет отправлять PNG (InlineQueryResultPhoto требует JPG).
+    html_content = f"<a href='{thumb_url}'>&#8203;</a>" \
+                   f"🎣 <b>Look at this catch!</b>\n\n" \
+                   f"🐠 <b>Fish:</b> {fish_id.capitalize()}\n" \
+                   f"⚖️ <b>Weight:</b> {weight_text} kg\n" \
+                   f"🔥 <b>Can you do better?</b>"
+
+    # ИСПОЛЬЗУЕМ КНОПКУ URL ВМЕСТО WEB_APP (чтобы избежать ошибки BUTTON_TYPE_INVALID)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="🎣 Try to catch better!", url=BOT_APP_LINK)
+    ]])
+
+    # Создаем результат типа ARTICLE (id одинаков для одного и того же улова)
+    return InlineQueryResultArticle(
+        id=hashlib.md5(f"{fish_id}|{weight_text}".encode()).hexdigest(),
+        title=f"Share {fish_id.capitalize()}",
+        description=f"Weight: {weight_text} kg",
+        thumbnail_url=thumb_url, # Если Телеграм не сможет загрузить PNG в меню выбора, он покажет плейсхолдер, но не ошибку
+        input_message_content=InputTextMessageContent(
+            message_text=html_content,
+            parse_mode="HTML",
+            disable_web_page_preview=False # ВАЖНО: Разрешаем превью, чтобы показалась большая картинка
+        ),
+        reply_markup=keyboard
+    )
+
+class ShareCache:
+    """Готовые результаты inline-шаринга по (fish_id, вес): собираются один раз, хранится не больше size."""
+    def __init__(self, size):
+        self.size = size
+        self.results = OrderedDict()   # (fish_id, weight) -> InlineQueryResultArticle, порядок = LRU
+
+    def get(self, fish_id, weight):
+        key = (fish_id, weight)
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+            INLINE_SHARES.inc("hit")
+            return result
+        INLINE_SHARES.inc("miss")
+        result = self.results[key] = build_share_result(fish_id, weight)
+        if len(self.results) > self.size: self.results.popitem(last=False)
+        return result
+
+share_cache = ShareCache(SHARE_CACHE_SIZE)
+
 @dp.inline_query()
 async def inline_share_catch(query: types.InlineQuery):
-    text = query.query.strip()
-    
-    # ЛОГИРУЕМ ЗАПРОС (для отладки)
-    logging.info(f"INLINE QUERY RECEIVED: {text}")
-
-    # Ожидаем формат запроса: "fish_id|weight|rarity"
-    if not text or "|" not in text:
+    # Ожидаем формат запроса: "fish_id|weight|rarity" (его подставляет кнопка "Поделиться")
+    catch = parse_share_query(query.query)
+    if catch is None:
+        INLINE_SHARES.inc("invalid")
         return
 
     try:
-        parts = text.split("|")
-        # Берем данные, только если есть хотя бы 2 части
-        if len(parts) < 2: return
-            
-        fish_id = parts[0]
-        weight = parts[1]
-        
-        # Ссылка на картинку. Удаляем trailing slash у WEBAPP_URL, если есть.
-        base_url = WEBAPP_URL.rstrip('/')
-        thumb_url = f"{base_url}/static/images/{fish_id}.png"
-        logging.info(f"Generated Thumb URL: {thumb_url}")
-        
-        # ХАК: Используем невидимую ссылку (zero-width char) для превью картинки.
-        # Это позволяет отправлять PNG (InlineQueryResultPhoto требует JPG).
-        html_content = f"<a href='{thumb_url}'>&#8203;</a>" \
-                       f"🎣 <b>Look at this catch!</b>\n\n" \
-                       f"🐠 <b>Fish:</b> {fish_id.capitalize()}\n" \
-                       f"⚖️ <b>Weight:</b> {weight} kg\n" \
-                       f"🔥 <b>Can you do better?</b>"
-
-        # ИСПОЛЬЗУЕМ КНОПКУ URL ВМЕСТО WEB_APP (чтобы избежать ошибки BUTTON_TYPE_INVALID)
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="🎣 Try to catch better!", url=BOT_APP_LINK)
-        ]])
-
-        # Создаем результат типа ARTICLE
-        result_id = hashlib.md5(text.encode()).hexdigest()
-
-        result = InlineQueryResultArticle(
-            id=result_id,
-            title=f"Share {fish_id.capitalize()}",
-            description=f"Weight: {weight} kg",
-            thumbnail_url=thumb_url, # Если Телеграм не сможет загрузить PNG в меню выбора, он покажет плейсхолдер, но не ошибку
-            input_message_content=InputTextMessageContent(
-                message_text=html_content,
-                parse_mode="HTML",
-                disable_web_page_preview=False # ВАЖНО: Разрешаем превью, чтобы показалась большая картинка
-            ),
-            reply_markup=keyboard
-        )
-
-        await query.answer([result], cache_time=0, is_personal=True)
-        logging.info("Inline answer sent successfully")
-        
+        # Ответ не зависит от пользователя: Telegram может отдавать его из своего кэша всем
+        await query.answer([share_cache.get(*catch)], cache_time=SHARE_CACHE_TIME, is_personal=False)
+        share_log(logging.INFO, f"Inline share answered: {catch[0]} {catch[1]} kg")
     except Exception as e:
-        logging.error(f"Inline error: {e}")
+        share_errors(logging.ERROR, f"Inline error: {e}")
+
+# !!! ВАЖНО !!! Явно разрешаем боту получать inline_query
+ALLOWED_UPDATES = ["message", "inline_query", "callback_query"]
+
+def update_chat_key(update):
+    """Ключ упорядочивания: чат сообщения, иначе автор (inline_query, callback без сообщения)."""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    chat = getattr(event, "chat", None)
+    if chat is not None: return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None: return user.id
+    return update.update_id
+
+class UpdatePool:
+    """Пул обработки апдейтов вебхука: N воркеров, каждый со своей ограниченной очередью.
+    Апдейты одного чата всегда попадают в один воркер, поэтому обрабатываются по порядку."""
+    def __init__(self, workers, queue_size):
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size // self.workers)
+        self.queues = []
+        self._tasks = []
+        self.stats = {"received": 0, "handled": 0, "failed": 0, "blocked": 0}
+
+    def start(self):
+        if self._tasks: return
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._run(queue)) for queue in self.queues]
+
+    async def submit(self, update):
+        self.start()
+        queue = self.queues[update_chat_key(update) % self.workers]
+        if queue.full():
+            # Backpressure: ответ Telegram задерживается, новые апдейты он пришлёт позже
+            self.stats["blocked"] += 1
+        await queue.put(update)
+        self.stats["received"] += 1
+
+    async def close(self):
+        """Дорабатывает уже принятые апдейты (вызывается при остановке)."""
+        for queue in self.queues:
+            await queue.put(None)
+        await asyncio.gather(*self._tasks)
+        self.queues, self._tasks = [], []
+
+    async def _run(self, queue):
+        while True:
+            update = await queue.get()
+            if update is None: return
+            try:
+                await dp.feed_update(bot, update)
+                self.stats["handled"] += 1
+            except Exception:
+                self.stats["failed"] += 1
+                logging.exception(f"Update {update.update_id} failed")
+
+update_pool = UpdatePool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE) if BOT_MODE == "webhook" else None
+
+async def telegram_webhook(request: Request):
+    """Приём апдейтов от Telegram: проверка секрета и постановка в пул, ответ - сразу."""
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return Response(status_code=401)
+    try:
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    except (ValueError, ValidationError) as e:
+        # Битое тело не станет лучше от повтора: отвечаем 200, чтобы Telegram не слал его снова
+        logging.warning(f"Malformed webhook update dropped: {e}")
+        return {"ok": False}
+    await update_pool.submit(update)
+    return {"ok": True}
+
+if update_pool is not None:
+    app.add_api_route(WEBHOOK_PATH, telegram_webhook, methods=["POST"], include_in_schema=False)
+
+async def init_db():
+    """Создание схемы, миграции и роллапы. Вызывается каждым процессом при старте,
+    до писателя SQLite и первых запросов, поэтому пишет своей транзакцией."""
+    async with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            # Несколько воркеров стартуют одновременно: схему готовит кто-то один
+            await conn.execute(text("SELECT pg_advisory_xact_lock(724201)"))
+        await migrate_catches(conn)
+        await conn.run_sync(Base.metadata.create_all)
+        await migrate_schema(conn)
+        await backfill_rollups(conn)
+        await backfill_fish_stats(conn)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as conn: await conn.run_sync(Base.metadata.create_all)
-    webhook = await bot.get_webhook_info()
-    if webhook.url: await bot.delete_webhook()
+    await init_db()
     
-    # !!! ВАЖНО !!! Явно разрешаем боту получать inline_query
-    asyncio.create_task(dp.start_polling(
-        bot, 
-        allowed_updates=["message", "inline_query", "callback_query"]
-    ))
+    if BOT_MODE == "polling":
+        webhook = await bot.get_webhook_info()
+        if webhook.url: await bot.delete_webhook()
+        asyncio.create_task(dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES))
+    
+    if update_pool is not None:
+        update_pool.start()
+        webhook = await bot.get_webhook_info()
+        # Каждый воркер стартует со своим lifespan: регистрируем вебхук, только если он ещё не наш
+        if webhook.url != WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
     
-    yield
-    await bot.session.close()
+    if catch_writer is not None:
+        catch_writer.start()
+    flush_task = None
+    if player_cache is not None:
+        flush_task = asyncio.create_task(player_cache.run(CACHE_FLUSH_INTERVAL))
+    lag_task = asyncio.create_task(watch_loop_lag(METRICS_LOOP_INTERVAL)) if METRICS_ENABLED else None
+    retention_task = asyncio.create_task(run_retention(RETENTION_INTERVAL)) if RETENTION_ENABLED else None
+    
+    try:
+        yield
+    finally:
+        if lag_task is not None:
+            lag_task.cancel()
+        if retention_task is not None:
+            retention_task.cancel()
+        # Гарантированно дописываем очередь уловов и сбрасываем кэш игроков перед остановкой
+        if update_pool is not None:
+            await update_pool.close()
+        if catch_writer is not None:
+            await catch_writer.close()
+        if flush_task is not None:
+            flush_task.cancel()
+            await player_cache.flush()
+        if sqlite_writer is not None:
+            await sqlite_writer.close()
+        await bot.session.close()
 
 app.router.lifespan_context = lifespan
\ No newline at end of file
@@ -0,0 +1,351 @@
+"""Симулятор экономики: сотни тысяч игроков за раз на массивах NumPy.
+
+Правила не копируются: шансы, выбор улова (FishSampler.pick_many), награды, цены и доход
+лодки берутся из game_rules.py - того же модуля, что использует сервер. Векторные клик и
+покупки перед прогоном сверяются с поштучными apply_click/apply_purchase на одних и тех же
+случайных числах, поэтому симуляция не может незаметно разойтись с продом.
+
+    pip install numpy
+    python simulate.py --players 100000 --days 3
+    python simulate.py --players 200000 --days 1 --bait common --strategy rod --out sim.json
+
+Модель игрока: --sessions-per-day заходов по --session-minutes минут. В сессии клик раз в
+--click-interval сек. (не чаще CLICK_COOLDOWN); без энергии - пауза --energy-wait сек. или
+энергетик (--drinks). Между сессиями копится доход лодки. Покупки жадные: удочка/лодка по
+--strategy, как только хватает денег, затем наживка (--bait), если она кончилась.
+"""
+import sys
+import json
+import time
+import argparse
+from types import SimpleNamespace
+
+import numpy as np
+
+from game_rules import (
+    ROD_PRICES, BOAT_PRICES, BOAT_INCOME, BOAT_MAX_HOURS, CONSUMABLES,
+    ENERGY_REGEN_PER_SEC, MAX_ENERGY, CLICK_COOLDOWN, ENERGY_COST, ACTIVE_REGEN_DELAY, BAIT_CODES,
+    START_BALANCE, START_BAIT_COMMON, FISH_TABLE,
+    get_fish_sampler, catch_chance, catch_reward, upgrade_price,
+    apply_click, apply_purchase, calculate_offline_progress
+)
+
+NO_PRICE = 2 ** 62  # максимальный уровень: купить нельзя
+PLAYER_FIELDS = ("balance", "energy", "rod_level", "boat_level", "bait_common", "bait_rare", "last_active_at")
+
+class Players:
+    """Состояние игроков столбцами: те же поля, что у User, по массиву на поле."""
+    def __init__(self, n):
+        # Как у нового игрока из /api/init: умолчания User плюс стартовый бонус
+        self.balance = np.full(n, START_BALANCE, np.int64)
+        self.energy = np.full(n, float(MAX_ENERGY))
+        self.rod_level = np.full(n, min(ROD_PRICES), np.int64)
+        self.boat_level = np.zeros(n, np.int64)
+        self.bait_common = np.full(n, START_BAIT_COMMON, np.int64)
+        self.bait_rare = np.zeros(n, np.int64)
+        self.last_active_at = np.zeros(n, np.int64)
+
+    def user(self, i):
+        """Игрок i как объект для поштучных правил game_rules."""
+        return SimpleNamespace(**{f: getattr(self, f)[i].item() for f in PLAYER_FIELDS})
+
+class Rules:
+    """Правила game_rules в виде таблиц: индекс - код наживки, уровень снасти, номер рыбы в FISH_TABLE."""
+    def __init__(self):
+        rods, boats, fish_count = max(ROD_PRICES) + 1, max(BOAT_PRICES) + 1, len(FISH_TABLE)
+        self.rods, self.fish_count = rods, fish_count
+        # Таблицы плоские: take по одному индексу заметно быстрее многомерной индексации
+        self.chance = np.zeros(len(BAIT_CODES) * rods)
+        # Ключ (наживка, удочка) -> номер сэмплера; одинаковые веса делят один FishSampler
+        self.samplers = []
+        self.sampler_of = np.zeros(len(BAIT_CODES) * rods, np.int64)
+        for bait, code in BAIT_CODES.items():
+            for rod_level in ROD_PRICES:
+                sampler = get_fish_sampler(bait, rod_level)
+                assert sampler.table is FISH_TABLE
+                if sampler not in self.samplers: self.samplers.append(sampler)
+                key = code * rods + rod_level
+                self.chance[key] = catch_chance(rod_level, bait)
+                self.sampler_of[key] = self.samplers.index(sampler)
+
+        self.reward = np.zeros(rods * fish_count, np.int64)
+        for rod_level in ROD_PRICES:
+            self.reward[rod_level * fish_count:(rod_level + 1) * fish_count] = [catch_reward(fish, rod_level) for fish in FISH_TABLE]
+
+        self.price = {
+            "rod": np.array([upgrade_price("rod", lvl) or NO_PRICE for lvl in range(rods)], np.int64),
+            "boat": np.array([upgrade_price("boat", lvl) or NO_PRICE for lvl in range(boats)], np.int64),
+        }
+        self.boat_income = np.array([BOAT_INCOME.get(lvl, 0) for lvl in range(boats)], float)
+        self.boat_seconds = np.array([BOAT_MAX_HOURS.get(lvl, 0) * 3600 for lvl in range(boats)], np.int64)
+
+    def offline_progress(self, p, mask, now, is_active=False):
+        """calculate_offline_progress для игроков из mask. Возвращает начисленный доход лодки."""
+        time_diff = np.maximum(now - p.last_active_at, 0)
+        earned = (np.minimum(time_diff, self.boat_seconds.take(p.boat_level)) * self.boat_income.take(p.boat_level)).astype(np.int64)
+        energy = np.minimum(MAX_ENERGY, p.energy + time_diff * ENERGY_REGEN_PER_SEC)
+        if is_active:
+            energy = np.where(time_diff > ACTIVE_REGEN_DELAY, energy, p.energy)
+        earned = np.where(mask, earned, 0)
+        p.balance += earned
+        p.energy = np.where(mask, energy, p.energy)
+        p.last_active_at = np.where(mask, now, p.last_active_at)
+        return earned
+
+    def click(self, p, mask, u_catch, u_fish):
+        """apply_click для игроков из mask; u_catch и u_fish - те же числа, что дал бы rnd()."""
+        clicked = mask & (p.energy >= ENERGY_COST)
+        bait = np.where(p.bait_rare > 0, BAIT_CODES["rare"],
+                        np.where(p.bait_common > 0, BAIT_CODES["common"], BAIT_CODES[None]))
+        p.bait_rare -= clicked & (bait == BAIT_CODES["rare"])
+        p.bait_common -= clicked & (bait == BAIT_CODES["common"])
+        p.energy = np.where(clicked, np.maximum(0.0, p.energy - ENERGY_COST), p.energy)
+
+        key = bait * self.rods + p.rod_level
+        caught = clicked & (u_catch <= self.chance.take(key))
+        # Рыба - тем же FishSampler, что на сервере, пачкой на каждый сэмплер
+        sampler_of = self.sampler_of.take(key)
+        fish = np.zeros(len(key), np.int64)
+        for number, sampler in enumerate(self.samplers):
+            group = sampler_of == number
+            fish[group] = sampler.pick_many(u_fish[group])
+        reward = np.where(caught, self.reward.take(p.rod_level * self.fish_count + fish), 0)
+        p.balance += reward
+        return clicked, caught, fish, reward
+
+    def purchase(self, p, mask, item_id):
+        """apply_purchase одного товара для игроков из mask. Возвращает маску успешных покупок."""
+        if item_id in ("rod", "boat"):
+            field = f"{item_id}_level"
+            price = self.price[item_id][getattr(p, field)]
+            bought = mask & (p.balance >= price)
+            p.balance -= np.where(bought, price, 0)
+            setattr(p, field, getattr(p, field) + bought)
+            return bought
+
+        item = CONSUMABLES[item_id]
+        bought = mask & (p.balance >= item['price'])
+        p.balance -= np.where(bought, item['price'], 0)
+        if item_id == "energy_drink":
+            p.energy = np.where(bought, np.minimum(MAX_ENERGY, p.energy + item['energy']), p.energy)
+        else:
+            setattr(p, item_id, getattr(p, item_id) + bought * item['amount'])
+        return bought
+
+def random_players(rng, n):
+    """Разнообразные состояния для сверки правил: все уровни, пустая и полная энергия, наживки."""
+    p = Players(n)
+    p.balance = np.floor(10 ** rng.uniform(0, 6.5, n)).astype(np.int64)
+    p.energy = np.where(rng.random(n) < 0.2, rng.choice([0.0, 1.0, ENERGY_COST, MAX_ENERGY], n), rng.uniform(0, MAX_ENERGY, n))
+    p.rod_level = rng.integers(min(ROD_PRICES), max(ROD_PRICES) + 1, n)
+    p.boat_level = rng.integers(0, max(BOAT_PRICES) + 1, n)
+    p.bait_common = rng.integers(0, 3, n)
+    p.bait_rare = rng.integers(0, 3, n)
+    p.last_active_at = rng.integers(1_000_000, 2_000_000, n)
+    return p
+
+def verify_rules(rules, rng, n):
+    """Векторные правила против поштучных из game_rules на одних и тех же случайных числах."""
+    p = random_players(rng, n)
+    users = [p.user(i) for i in range(n)]
+    # Паузы от частых кликов до многочасового отсутствия
+    now = p.last_active_at + np.where(rng.random(n) < 0.5, rng.integers(0, 2 * ACTIVE_REGEN_DELAY, n), rng.integers(0, 30 * 3600, n))
+    u_catch, u_fish = rng.random(n), rng.random(n)
+    items = rng.choice(["rod", "boat", *CONSUMABLES], n)
+    later = now + rng.integers(0, 600, n)
+
+    everyone = np.ones(n, bool)
+    rules.offline_progress(p, everyone, now, is_active=True)
+    clicked, caught, fish, reward = rules.click(p, everyone, u_catch, u_fish)
+    rules.offline_progress(p, everyone, later)
+    bought = np.zeros(n, bool)
+    for item_id in ("rod", "boat", *CONSUMABLES):
+        bought |= rules.purchase(p, items == item_id, item_id)
+
+    for i, user in enumerate(users):
+        calculate_offline_progress(user, int(now[i]), is_active=True)
+        status, fish_row, reward_i, _ = apply_click(user, iter([u_catch[i], u_fish[i]]).__next__)
+        calculate_offline_progress(user, int(later[i]))
+        success = apply_purchase(user, items[i])
+        expected = (status != "no_energy", status == "caught", reward_i, success, *(getattr(user, f) for f in PLAYER_FIELDS))
+        got = (clicked[i], caught[i], reward[i], bought[i], *(getattr(p, f)[i] for f in PLAYER_FIELDS))
+        if status == "caught" and FISH_TABLE[fish[i]] is not fish_row or expected != tuple(x.item() for x in got):
+            raise RuntimeError(f"simulation rules drifted from game_rules for player {i}: expected {expected}, got {got}")
+
+def percentiles(values, qs=(10, 50, 90)):
+    if len(values) == 0: return {f"p{q}": None for q in qs}
+    return {f"p{q}": round(float(v), 2) for q, v in zip(qs, np.percentile(values, qs))}
+
+def simulate(args, rules, rng):
+    n = args.players
+    horizon = args.days * 86400
+    session = args.session_minutes * 60
+    away = 86400 / args.sessions_per_day - session
+    checkpoints = np.arange(args.sample_hours * 3600, horizon + 1, args.sample_hours * 3600)
+    trace = min(args.trace, n)
+
+    p = Players(n)
+    t = np.zeros(n)  # время следующего действия, с от регистрации игрока
+    session_end = t + session
+    # Время достижения уровня (в часах) для каждого игрока и уровня; inf - не достиг
+    reached = {
+        "rod": np.full((n, max(ROD_PRICES) + 1), np.inf, np.float32),
+        "boat": np.full((n, max(BOAT_PRICES) + 1), np.inf, np.float32),
+    }
+    reached["rod"][:, min(ROD_PRICES)] = 0
+    reached["boat"][:, 0] = 0
+    # Деньги на руках у первых trace игроков в контрольные моменты
+    balance_curve = np.zeros((len(checkpoints), trace), np.int64)
+    next_checkpoint = np.zeros(trace, np.int64)
+    totals = {key: 0 for key in ("clicks", "no_energy", "catches", "trash", "fish_income", "boat_income", "sessions")}
+    spent = {item_id: 0 for item_id in ("rod", "boat", *CONSUMABLES)}
+    is_trash = np.array([fish['is_trash'] for fish in FISH_TABLE])
+    steps = 0
+
+    live = t < horizon
+    while live.any():
+        steps += 1
+        now = np.floor(t).astype(np.int64)
+        totals["boat_income"] += int(rules.offline_progress(p, live, now, is_active=True).sum())
+        clicked, caught, fish, reward = rules.click(p, live, rng.random(n), rng.random(n))
+        totals["clicks"] += int(clicked.sum())
+        totals["no_energy"] += int((live & ~clicked).sum())
+        totals["catches"] += int(caught.sum())
+        totals["trash"] += int((caught & is_trash[fish]).sum())
+        totals["fish_income"] += int(reward.sum())
+
+        refreshed = np.zeros(n, bool)
+        if args.drinks:
+            refreshed = rules.purchase(p, live & ~clicked, "energy_drink")
+            spent["energy_drink"] += int(refreshed.sum()) * CONSUMABLES["energy_drink"]["price"]
+
+        # Снасти: какую брать следующей по стратегии
+        rod_price, boat_price = rules.price["rod"][p.rod_level], rules.price["boat"][p.boat_level]
+        if args.strategy == "cheapest": want_rod = rod_price <= boat_price
+        elif args.strategy == "rod": want_rod = rod_price < NO_PRICE
+        else: want_rod = boat_price >= NO_PRICE
+        for item_id, mask, price in (("rod", want_rod, rod_price), ("boat", ~want_rod, boat_price)):
+            bought = rules.purchase(p, live & mask, item_id)
+            spent[item_id] += int(price[bought].sum())
+            level = getattr(p, f"{item_id}_level")
+            who = np.flatnonzero(bought)
+            reached[item_id][who, level[who]] = t[who] / 3600
+
+        if args.bait:
+            item_id = f"bait_{args.bait}"
+            bought = rules.purchase(p, live & (getattr(p, item_id) == 0), item_id)
+            spent[item_id] += int(bought.sum()) * CONSUMABLES[item_id]["price"]
+
+        # Следующее действие: клик, ожидание энергии или конец сессии
+        busy = clicked | refreshed
+        gap = np.where(busy, args.click_interval * rng.uniform(0.8, 1.2, n), args.energy_wait * rng.uniform(0.5, 1.5, n))
+        next_t = t + np.maximum(gap, CLICK_COOLDOWN)
+        leaving = live & (next_t >= session_end)
+        next_t = np.where(leaving, session_end + away * rng.uniform(0.75, 1.25, n), next_t)
+        session_end = np.where(leaving, next_t + session, session_end)
+        totals["sessions"] += int(leaving.sum())
+
+        # Контрольные моменты между этим действием и следующим
+        crossing = live[:trace] & (next_checkpoint < len(checkpoints))
+        while True:
+            crossing &= checkpoints[np.minimum(next_checkpoint, len(checkpoints) - 1)] <= next_t[:trace]
+            crossing &= next_checkpoint < len(checkpoints)
+            who = np.flatnonzero(crossing)
+            if not len(who): break
+            balance_curve[next_checkpoint[who], who] = p.balance[who]
+            next_checkpoint[who] += 1
+
+        t = np.where(live, next_t, t)
+        live = t < horizon
+
+    curves = []
+    for k, at in enumerate(checkpoints):
+        hours = at / 3600
+        rod = (reached["rod"] <= hours).sum(axis=1) - 1 + min(ROD_PRICES)
+        boat = (reached["boat"] <= hours).sum(axis=1) - 1
+        curves.append({
+            "hour": round(hours, 2),
+            "rod_mean": round(float(rod.mean()), 2), "rod": percentiles(rod),
+            "boat_mean": round(float(boat.mean()), 2), "boat": percentiles(boat),
+            "balance": percentiles(balance_curve[k]),
+        })
+
+    time_to_level = {}
+    for item_id, times in reached.items():
+        first = min(ROD_PRICES) + 1 if item_id == "rod" else 1
+        time_to_level[item_id] = {
+            level: {"reached": round(float(np.isfinite(times[:, level]).mean()), 4), **percentiles(times[np.isfinite(times[:, level]), level])}
+            for level in range(first, times.shape[1])
+        }
+
+    return {
+        "steps": steps,
+        "per_player": {key: round(value / n, 2) for key, value in totals.items()},
+        "spent_per_player": {key: round(value / n, 2) for key, value in spent.items()},
+        "final_balance": percentiles(p.balance),
+        "curves": curves,
+        "time_to_level_hours": time_to_level,
+    }
+
+def print_report(result):
+    print(f"\n{result['players']} players x {result['days']} days: {result['steps']} steps in {result['elapsed']} s")
+    print("per player:", ", ".join(f"{k} {v}" for k, v in result["per_player"].items()))
+    print("spent:", ", ".join(f"{k} {v}" for k, v in result["spent_per_player"].items()))
+    print(f"\n{'hour':>7}{'rod avg':>9}{'rod p50':>9}{'boat avg':>10}{'balance p10':>13}{'p50':>11}{'p90':>11}")
+    for row in result["curves"]:
+        b = row["balance"]
+        print(f"{row['hour']:>7}{row['rod_mean']:>9}{row['rod']['p50']:>9}{row['boat_mean']:>10}"
+              f"{b['p10'] if b['p10'] is not None else '-':>13}{b['p50'] if b['p50'] is not None else '-':>11}{b['p90'] if b['p90'] is not None else '-':>11}")
+    print(f"\n{'level':<10}{'reached':>9}{'p10 h':>9}{'p50 h':>9}{'p90 h':>9}")
+    for item_id, levels in result["time_to_level_hours"].items():
+        for level, row in levels.items():
+            cells = "".join(f"{row[q] if row[q] is not None else '-':>9}" for q in ("p10", "p50", "p90"))
+            print(f"{item_id + ' ' + str(level):<10}{row['reached'] * 100:>8.1f}%{cells}")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Симулятор экономики FishingGame")
+    parser.add_argument("--players", type=int, default=100_000)
+    parser.add_argument("--days", type=float, default=3)
+    parser.add_argument("--sessions-per-day", type=float, default=4)
+    parser.add_argument("--session-minutes", type=float, default=10)
+    parser.add_argument("--click-interval", type=float, default=1.0, help="средняя пауза между кликами, с")
+    parser.add_argument("--energy-wait", type=float, default=20, help="средняя пауза без энергии, с")
+    parser.add_argument("--drinks", action="store_true", help="без энергии покупать энергетик, если хватает денег")
+    parser.add_argument("--bait", choices=("common", "rare"), help="докупать наживку, когда она кончилась")
+    parser.add_argument("--strategy", choices=("cheapest", "rod", "boat"), default="cheapest",
+                        help="что покупать первым: более дешёвую снасть, удочки или лодки")
+    parser.add_argument("--sample-hours", type=float, default=6, help="шаг кривых прогресса, ч")
+    parser.add_argument("--trace", type=int, default=10_000, help="по скольким игрокам строить кривую денег")
+    parser.add_argument("--check", type=int, default=20_000, help="сколько случайных состояний сверить с game_rules (0 - не сверять)")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--out", help="JSON с результатом")
+    args = parser.parse_args()
+
+    if args.click_interval < CLICK_COOLDOWN:
+        parser.error(f"--click-interval can't be below CLICK_COOLDOWN ({CLICK_COOLDOWN} s)")
+    if args.session_minutes * 60 >= 86400 / args.sessions_per_day:
+        parser.error("sessions don't fit into a day")
+
+    rng = np.random.default_rng(args.seed)
+    rules = Rules()
+    if args.check:
+        started = time.perf_counter()
+        verify_rules(rules, rng, args.check)
+        print(f"rules check: {args.check} random states match game_rules ({time.perf_counter() - started:.1f} s)", file=sys.stderr)
+
+    started = time.perf_counter()
+    result = simulate(args, rules, rng)
+    result = {
+        "players": args.players,
+        "days": args.days,
+        "elapsed": round(time.perf_counter() - started, 2),
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "check")},
+        **result,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    print_report(result)
+
+if __name__ == "__main__":
+    main_cli()